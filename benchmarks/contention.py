@@ -0,0 +1,84 @@
+"""
+Measure the throughput and latency of model class resolutions performed by
+concurrent threads while another thread keeps rebuilding model classes.
+
+Usage: DJANGO_SETTINGS_MODULE=tests.settings.sqlite3 python -m benchmarks.contention
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import threading
+import time
+
+import django
+
+
+def resolve(model_def, duration, start, latencies):
+    start.wait()
+    deadline = time.time() + duration
+    while True:
+        begin = time.time()
+        if begin > deadline:
+            return
+        model_def.model_class()._meta
+        latencies.append(time.time() - begin)
+
+
+def rebuild(model_def, state, stop):
+    while not stop.is_set():
+        model_class = model_def.model_class().model
+        model_def.construct(True, model_class, state.clone())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--duration', type=float, default=2)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    django.setup()
+
+    from django.test.runner import DiscoverRunner
+
+    from mutant.models import ModelDefinition
+
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        model_defs = [
+            ModelDefinition.objects.create(app_label='mutant', object_name="Contention%d" % i)
+            for i in range(8)
+        ]
+        rebuilt_def = ModelDefinition.objects.create(app_label='mutant', object_name='Rebuilt')
+        # Retrieving the state involves queries which are not of interest.
+        state = rebuilt_def.get_state()
+        for count in args.threads:
+            start, stop = threading.Event(), threading.Event()
+            latencies = [[] for _i in range(count)]
+            readers = [
+                threading.Thread(
+                    target=resolve, args=(model_defs[i % len(model_defs)], args.duration, start, latencies[i])
+                ) for i in range(count)
+            ]
+            writer = threading.Thread(target=rebuild, args=(rebuilt_def, state, stop))
+            for reader in readers:
+                reader.start()
+            writer.start()
+            start.set()
+            for reader in readers:
+                reader.join()
+            stop.set()
+            writer.join()
+            latencies = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+            print("%3d threads %10.0f resolutions/s %8.3f ms p99 %8.3f ms max" % (
+                count, len(latencies) / args.duration,
+                latencies[int(len(latencies) * 0.99)] * 1e3, latencies[-1] * 1e3,
+            ))
+        for model_def in model_defs + [rebuilt_def]:
+            model_def.delete()
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Measure the delivery latency and throughput of pub/sub engines.
+
+Usage: DJANGO_SETTINGS_MODULE=tests.settings.sqlite3 python -m benchmarks.engines
+
+The Unix socket engine is always measured; pass --redis to also measure the
+Redis engine against a running server.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import shutil
+import tempfile
+import time
+from threading import Event
+
+import django
+
+
+class Subscriber(object):
+    def __init__(self):
+        self.received = 0
+        self.expected = 0
+        self.event = Event()
+
+    def expect(self, count):
+        self.received = 0
+        self.expected = count
+        self.event.clear()
+
+    def __call__(self, *args):
+        self.received += 1
+        if self.received >= self.expected:
+            self.event.set()
+
+
+def start(engine_cls, subscriber, **options):
+    engine = engine_cls(lambda: None, subscriber, **options)
+    engine.start()
+    while not engine.ready:
+        time.sleep(0.01)
+    return engine
+
+
+def bench(label, engine_cls, messages, rounds, **options):
+    subscriber = Subscriber()
+    # Publish from a distinct engine instance as a different process would.
+    listener = start(engine_cls, subscriber, **options)
+    publisher = start(engine_cls, lambda *args: None, **options)
+    latencies = []
+    for definition_pk in range(rounds):
+        subscriber.expect(1)
+        begin = time.time()
+        publisher.publish(definition_pk, 'checksum', begin)
+        subscriber.event.wait(5)
+        latencies.append(time.time() - begin)
+    latencies.sort()
+    subscriber.expect(messages)
+    begin = time.time()
+    publisher.publish_many([(definition_pk, 'checksum', begin) for definition_pk in range(messages)])
+    subscriber.event.wait(30)
+    elapsed = time.time() - begin
+    print("%-12s p50 %8.1f us, p99 %8.1f us, %10.0f msg/s" % (
+        label,
+        latencies[len(latencies) // 2] * 1e6,
+        latencies[int(len(latencies) * 0.99)] * 1e6,
+        subscriber.received / elapsed,
+    ))
+    publisher.stop()
+    listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=1000)
+    parser.add_argument('--redis', action='store_true')
+    args = parser.parse_args()
+
+    django.setup()
+
+    from mutant.state.handlers.pubsub import engines
+
+    path = tempfile.mkdtemp()
+    try:
+        bench('unix socket', engines.UnixSocket, args.messages, args.rounds, path=path)
+    finally:
+        shutil.rmtree(path)
+    if args.redis:
+        bench('redis', engines.Redis, args.messages, args.rounds, channel='mutant-benchmark')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Compare the cost of attribute access on a mutable model proxy against a plain
+Django model.
+
+Usage: DJANGO_SETTINGS_MODULE=tests.settings.sqlite3 python -m benchmarks.proxy
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import timeit
+
+import django
+
+
+def access(model):
+    model._meta
+    model.objects
+    model.DoesNotExist
+
+
+def bench(label, func, number, repeat):
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    print("%-32s %8.3f us/access" % (label, best / number / 3 * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    django.setup()
+
+    from django.contrib.contenttypes.models import ContentType
+    from django.test.runner import DiscoverRunner
+
+    from mutant import settings
+    from mutant.db.models import cache_model_resolution
+    from mutant.models import ModelDefinition
+
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        model_def = ModelDefinition.objects.create(app_label='mutant', object_name='Benchmark')
+        proxy = model_def.model_class()
+
+        bench('plain model', lambda: access(ContentType), args.number, args.repeat)
+        bench('proxy', lambda: access(proxy), args.number, args.repeat)
+        with cache_model_resolution():
+            bench('proxy (resolution cache)', lambda: access(proxy), args.number, args.repeat)
+        staleness_window = settings.STATE_STALENESS_WINDOW
+        settings.STATE_STALENESS_WINDOW = 60
+        try:
+            bench('proxy (staleness window)', lambda: access(proxy), args.number, args.repeat)
+        finally:
+            settings.STATE_STALENESS_WINDOW = staleness_window
+        model_def.delete()
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Compare the checksum publishing throughput of the pub/sub state handler with
+and without batching.
+
+Usage: DJANGO_SETTINGS_MODULE=tests.settings.sqlite3 python -m benchmarks.pubsub
+
+By default an in-process engine simulating a network round trip per publish
+is used; pass --redis to publish through a Redis server instead.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import time
+
+import django
+
+
+class LatencyEngine(object):
+    """Engine simulating a network round trip per publish."""
+
+    latency = 0
+
+    def __init__(self, initialize, callback):
+        self.initialize = initialize
+        self.ready = False
+
+    def start(self):
+        self.initialize()
+        self.ready = True
+
+    def stop(self, timeout=None):
+        pass
+
+    def publish(self, *args):
+        time.sleep(self.latency)
+
+    def publish_many(self, messages):
+        time.sleep(self.latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='Simulated round trip duration in seconds.')
+    parser.add_argument('--interval', type=float, default=0.005)
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--redis', action='store_true')
+    args = parser.parse_args()
+
+    django.setup()
+
+    from mutant.state.handlers.pubsub import PubSubStateHandler
+
+    LatencyEngine.latency = args.latency
+    if args.redis:
+        engine = ('mutant.state.handlers.pubsub.engines.Redis', {'channel': 'mutant-benchmark'})
+    else:
+        engine = ('%s.LatencyEngine' % __name__, {})
+
+    for label, batch in [
+            ('unbatched', None),
+            ('batched', {'interval': args.interval, 'size': args.size})]:
+        handler = PubSubStateHandler(engine=engine, batch=batch)
+        start = time.time()
+        for definition_pk in range(args.messages):
+            handler.set_checksum(definition_pk, 'checksum')
+        enqueued = time.time() - start
+        if batch:
+            handler.publisher.flush()
+        published = time.time() - start
+        print("%-10s %8.0f msg/s published, %8.0f msg/s on the calling thread" % (
+            label, args.messages / published, args.messages / enqueued
+        ))
+        if batch:
+            handler.publisher.stop()
+        handler.engine.stop()
+
+
+if __name__ == '__main__':
+    main()
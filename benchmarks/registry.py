@@ -0,0 +1,64 @@
+"""
+Measure the cost of rebuilding a mutable model class as the number of models
+registered in the project grows.
+
+Usage: DJANGO_SETTINGS_MODULE=tests.settings.sqlite3 python -m benchmarks.registry
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import timeit
+
+import django
+
+
+def create_models(count, offset):
+    from django.db import models
+
+    for i in range(offset, offset + count):
+        type(str("Filler%d" % i), (models.Model,), {
+            '__module__': __name__,
+            'Meta': type(str('Meta'), (), {'app_label': 'mutant', 'managed': False}),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    django.setup()
+
+    from django.contrib.contenttypes.models import ContentType
+    from django.test.runner import DiscoverRunner
+
+    from mutant.models import ModelDefinition
+
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        model_def = ModelDefinition.objects.create(app_label='mutant', object_name='Benchmark')
+        # Retrieving the state of a definition involves polymorphic lookups
+        # which scale with the number of models; leave it out.
+        state = model_def.get_state()
+
+        def rebuild():
+            model_class = model_def.model_class().model
+            model_def.construct(True, model_class, state.clone())
+            # Static models are expected to keep their caches around.
+            ContentType._meta.get_fields()
+
+        models = 0
+        for count in (0, 1000, 5000):
+            create_models(count - models, models)
+            models = count
+            best = min(timeit.repeat(rebuild, number=args.number, repeat=args.repeat))
+            print("%5d extra models %8.3f ms/rebuild" % (count, best / args.number * 1e3))
+        model_def.delete()
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Measure the hot paths of mutable models.
+
+Usage: DJANGO_SETTINGS_MODULE=tests.settings.sqlite3 python -m benchmarks.suite
+
+Use tests.settings.postgresql_psycopg2 to run against a local PostgreSQL
+database. Pass --json to write the results to a file and --compare to report
+the relative change against a previous run.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import time
+from functools import partial
+
+import django
+
+from .proxy import access
+
+benchmarks = []
+
+
+def benchmark(func):
+    benchmarks.append(func)
+    return func
+
+
+def measure(func, repeat, setup=None):
+    durations = []
+    for _i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return durations
+
+
+def result(name, durations, **params):
+    durations = sorted(durations)
+    return {
+        'name': name,
+        'params': params,
+        'runs': len(durations),
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'mean': sum(durations) / len(durations),
+    }
+
+
+def create_definition(object_name, fields=0):
+    from mutant.contrib.text.models import CharFieldDefinition
+    from mutant.models import ModelDefinition
+
+    with ModelDefinition.objects.bulk_alter():
+        model_def = ModelDefinition.objects.create(app_label='mutant', object_name=object_name)
+        for i in range(fields):
+            CharFieldDefinition.objects.create(model_def=model_def, name="field%d" % i, max_length=100)
+    return model_def
+
+
+@benchmark
+def construction(args):
+    results = []
+    for fields in (1, 10, 50):
+        model_def = create_definition("Construction%d" % fields, fields)
+        durations = measure(partial(model_def.model_class, force_create=True), args.repeat)
+        results.append(result('construction', durations, fields=fields))
+        model_def.delete()
+    return results
+
+
+@benchmark
+def proxy_access(args):
+    from django.contrib.contenttypes.models import ContentType
+
+    model_def = create_definition('ProxyAccess')
+    proxy = model_def.model_class()
+    results = []
+    for label, model in [('plain', ContentType), ('proxy', proxy)]:
+        durations = measure(lambda: [access(model) for _i in range(args.number)], args.repeat)
+        results.append(result('proxy_access', durations, model=label, number=args.number))
+    model_def.delete()
+    return results
+
+
+@benchmark
+def is_obsolete(args):
+    from django.apps import apps
+
+    from mutant.state.handlers.cache import CacheStateHandler
+    from mutant.state.handlers.database import DatabaseStateHandler
+    from mutant.state.handlers.layered import LayeredStateHandler
+    from mutant.state.handlers.memory import MemoryStateHandler
+    from mutant.state.handlers.pubsub import PubSubStateHandler
+
+    mutant_config = apps.get_app_config('mutant')
+    state_handler = mutant_config.state_handler
+    path = tempfile.mkdtemp()
+    handlers = [
+        ('memory', MemoryStateHandler),
+        ('cache', CacheStateHandler),
+        ('layered', LayeredStateHandler),
+        ('database', DatabaseStateHandler),
+        ('pubsub', partial(
+            PubSubStateHandler, engine=('mutant.state.handlers.pubsub.engines.UnixSocket', {'path': path})
+        )),
+    ]
+    model_def = create_definition('IsObsolete')
+    results = []
+    try:
+        for label, handler_cls in handlers:
+            mutant_config.state_handler = handler = handler_cls()
+            model_class = model_def.model_class(force_create=True).model
+            durations = measure(
+                lambda: [model_class.is_obsolete() for _i in range(args.number)], args.repeat
+            )
+            results.append(result('is_obsolete', durations, handler=label, number=args.number))
+            engine = getattr(handler, 'engine', None)
+            if engine is not None:
+                engine.stop()
+    finally:
+        mutant_config.state_handler = state_handler
+        shutil.rmtree(path)
+    model_def.delete()
+    return results
+
+
+@benchmark
+def field_ddl(args):
+    from mutant.contrib.text.models import CharFieldDefinition
+
+    model_def = create_definition('FieldDDL', 10)
+    added, altered, removed = [], [], []
+    for _i in range(args.repeat):
+        start = time.time()
+        field_def = CharFieldDefinition.objects.create(model_def=model_def, name='field', max_length=100)
+        added.append(time.time() - start)
+        field_def.max_length = 200
+        start = time.time()
+        field_def.save()
+        altered.append(time.time() - start)
+        start = time.time()
+        field_def.delete()
+        removed.append(time.time() - start)
+    model_def.delete()
+    return [
+        result('field_ddl', added, operation='add'),
+        result('field_ddl', altered, operation='alter'),
+        result('field_ddl', removed, operation='remove'),
+    ]
+
+
+@benchmark
+def fixture_loading(args):
+    from django.core.management import call_command
+
+    from mutant.models import ModelDefinition
+
+    def delete():
+        ModelDefinition.objects.filter(pk=9999).delete()
+
+    durations = measure(
+        partial(call_command, 'loaddata', 'fixture_loading_test', verbosity=0), args.repeat, setup=delete
+    )
+    delete()
+    return [result('fixture_loading', durations)]
+
+
+@benchmark
+def invalidation(args):
+    from mutant.contrib.related.models import ForeignKeyDefinition
+
+    results = []
+    hub = create_definition('Hub')
+    dependents = []
+    for count in (1, 10, 50):
+        while len(dependents) < count:
+            dependent = create_definition("Dependent%d" % len(dependents))
+            ForeignKeyDefinition.objects.create(model_def=dependent, name='hub', null=True, to=hub.model_ct)
+            dependents.append(dependent)
+        model_classes = [model_def.model_class().model for model_def in [hub] + dependents]
+
+        def reset():
+            for model_class in model_classes:
+                model_class._is_obsolete = False
+        durations = measure(model_classes[0].mark_as_obsolete, args.repeat, setup=reset)
+        results.append(result('invalidation', durations, dependents=count))
+    for model_def in dependents + [hub]:
+        model_def.delete()
+    return results
+
+
+def get_key(entry):
+    return entry['name'], tuple(sorted(entry['params'].items()))
+
+
+def report(results, baseline=None):
+    baseline = dict((get_key(entry), entry) for entry in baseline or [])
+    for entry in results:
+        params = ', '.join("%s=%s" % item for item in sorted(entry['params'].items()))
+        line = "%-16s %-36s %12.3f ms" % (entry['name'], params, entry['median'] * 1e3)
+        previous = baseline.get(get_key(entry))
+        if previous is not None:
+            line += " %+8.1f%%" % ((entry['median'] / previous['median'] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--filter', help='Only run the benchmarks whose name contain this value.')
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--compare', help='Compare the results to the ones stored in this file.')
+    args = parser.parse_args()
+
+    django.setup()
+
+    from django.db import connection
+    from django.test.runner import DiscoverRunner
+
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        results = []
+        for func in benchmarks:
+            if args.filter and args.filter not in func.__name__:
+                continue
+            results.extend(func(args))
+    finally:
+        runner.teardown_databases(old_config)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({
+                'vendor': connection.vendor,
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,4 +10,13 @@ __version__ = get_version(VERSION)
 
 logger = logging.getLogger('mutant')
 
+
+def defer_rebuilds():
+    """
+    Return a context manager coalescing the model class rebuilds of the
+    definitions altered in its block until it exits.
+    """
+    from .management import defer_rebuilds
+    return defer_rebuilds()
+
 default_app_config = 'mutant.apps.MutantConfig'
@@ -11,11 +11,17 @@ class MutantConfig(AppConfig):
     name = 'mutant'
 
     def ready(self):
+        self.metrics = import_string(settings.METRICS)()
         self.state_handler = import_string(settings.STATE_HANDLER)()
 
         from . import management
 
         ModelDefinition = self.get_model('ModelDefinition')
+        models.signals.pre_save.connect(
+            management.raw_model_definition_pre_save,
+            sender=ModelDefinition,
+            dispatch_uid='mutant.management.raw_model_definition_pre_save',
+        )
         models.signals.post_save.connect(
             management.model_definition_post_save,
             sender=ModelDefinition,
@@ -49,6 +55,14 @@ class MutantConfig(AppConfig):
             dispatch_uid='mutant.management.base_definition_post_delete',
         )
 
+        for model_name in ('BaseDefinition', 'OrderingFieldDefinition', 'UniqueTogetherDefinition',
+                           'FieldDefinitionChoice'):
+            models.signals.post_save.connect(
+                management.raw_definition_attribute_post_save,
+                sender=self.get_model(model_name),
+                dispatch_uid="mutant.management.raw_%s_post_save" % model_name.lower(),
+            )
+
         UniqueTogetherDefinition = self.get_model('UniqueTogetherDefinition')
         models.signals.m2m_changed.connect(
             management.unique_together_field_defs_changed,
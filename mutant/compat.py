@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 from operator import attrgetter
 
 import django
+from django.db import transaction
 
 get_remote_field = attrgetter('remote_field' if django.VERSION >= (1, 9) else 'rel')
 
@@ -19,6 +20,8 @@ if django.VERSION >= (1, 9):
 
     def many_to_many_set(instance, m2m, value):
         getattr(instance, m2m).set(value)
+
+    on_commit = transaction.on_commit
 else:
     def get_remote_field_model(field):
         return getattr(getattr(field, 'rel', None), 'to', None)
@@ -28,3 +31,19 @@ else:
 
     def many_to_many_set(instance, m2m, value):
         setattr(instance, m2m, value)
+
+    def on_commit(func, using=None):
+        func()
+
+if django.VERSION >= (1, 10):
+    from django.db.models import prefetch_related_objects
+    from django.utils.deprecation import MiddlewareMixin
+else:
+    from django.db.models.query import prefetch_related_objects as _prefetch_related_objects
+
+    def prefetch_related_objects(model_instances, *related_lookups):
+        _prefetch_related_objects(model_instances, related_lookups)
+
+    class MiddlewareMixin(object):
+        def __init__(self, get_response=None):
+            self.get_response = get_response
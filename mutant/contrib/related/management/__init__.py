@@ -38,6 +38,13 @@ def mutable_model_prepared(signal, sender, definition, existing_model_class,
         Q(fielddefinitions__foreignkeydefinition__to=definition) |
         Q(fielddefinitions__manytomanyfielddefinition__to=definition)
     ).distinct()
+    # Referring models must be rebuilt if the definition was renamed
+    if existing_model_class:
+        existing_opts, opts = existing_model_class._meta, sender._meta
+        if (existing_opts.app_label, existing_opts.model_name) != (opts.app_label, opts.model_name):
+            for model_def in ModelDefinition.objects.filter(
+                    pk__in=related_model_defs.values('pk')).exclude(pk=definition.pk):
+                model_def.bump_revision()
     for model_def in related_model_defs:
         if model_def != definition:
             # Generate model class from definition and add it as a dependency
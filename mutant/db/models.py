@@ -1,16 +1,323 @@
 from __future__ import unicode_literals
 
-from django.core.exceptions import ValidationError
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock, RLock, local
+from weakref import WeakSet
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.db import models
 from django.db.migrations.state import ModelState, StateApps
 from django.utils.six import string_types
 from django.utils.translation import ugettext_lazy as _
 
-from .. import logger
-from ..compat import get_remote_field_model
+from .. import logger, settings
+from ..compat import get_remote_field, get_remote_field_model
+from ..metrics import metrics
 from ..state import handler as state_handler
 
 
+class ChecksumLookupCounter(object):
+    """Keep track of the number of state handler lookups performed and
+    avoided by `MutableModel.is_obsolete()`."""
+
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        return "<ChecksumLookupCounter: performed=%d avoided=%d>" % (self.performed, self.avoided)
+
+    def reset(self):
+        self.performed = 0
+        self.avoided = 0
+
+
+checksum_lookups = ChecksumLookupCounter()
+
+
+class ModelResolutionCache(local):
+    """Thread local cache of the model classes resolved by proxies keyed by
+    definition primary key. It's only active within `cache_model_resolution`
+    blocks."""
+
+    def __init__(self):
+        self.models = None
+        self.depth = 0
+
+    def enable(self):
+        if self.depth == 0:
+            self.models = {}
+        self.depth += 1
+
+    def disable(self):
+        if self.depth > 0:
+            self.depth -= 1
+            if self.depth == 0:
+                self.models = None
+
+    def get(self, definition_pk):
+        if self.models is not None:
+            return self.models.get(definition_pk)
+
+    def set(self, definition_pk, model_class):
+        if self.models is not None:
+            self.models[definition_pk] = model_class
+
+    def invalidate(self, definition_pk=None):
+        if self.models is not None:
+            if definition_pk is None:
+                self.models.clear()
+            else:
+                self.models.pop(definition_pk, None)
+
+
+model_resolution_cache = ModelResolutionCache()
+
+
+@contextmanager
+def cache_model_resolution():
+    """
+    Trust the model classes resolved by proxies for the duration of the block
+    instead of checking whether or not they are obsolete on each access.
+
+    Changes made by the current thread are noticed immediately while changes
+    made by other threads and processes are ignored until the block exits
+    or `invalidate_model_resolution()` is called.
+    """
+    model_resolution_cache.enable()
+    try:
+        yield
+    finally:
+        model_resolution_cache.disable()
+
+
+def invalidate_model_resolution(definition_pk=None):
+    """Forget the model class resolved for `definition_pk` or all of them."""
+    model_resolution_cache.invalidate(definition_pk)
+
+
+class RenderedStateCache(object):
+    """
+    Cache of the migration state renderings of mutable models keyed by
+    definition. At most `size` entries are kept, the least recently used
+    ones being discarded first.
+
+    The states of the models a mutable model is related to are built once
+    and reused until one of the loaded model classes they were built from
+    changes. They are rendered once and reused while the model state itself
+    is only re-rendered when it differs from the previously rendered one.
+    Models referencing the model must point to its rendering hence they are
+    rendered along with it in that case.
+    """
+
+    def __init__(self, size=None):
+        self.size = settings.RENDERED_STATES_CACHE_SIZE if size is None else size
+        self.lock = RLock()
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def get_references(state):
+        references = set()
+        for _name, field in state.fields:
+            related_model = get_remote_field_model(field)
+            if related_model is not None:
+                if isinstance(related_model, string_types):
+                    references.add(related_model.lower())
+                else:
+                    references.add(related_model._meta.label_lower)
+        return references
+
+    @staticmethod
+    def references(state, label):
+        for _name, field in state.fields:
+            related_model = get_remote_field_model(field)
+            if isinstance(related_model, string_types) and related_model.lower() == label:
+                return True
+        return False
+
+    @staticmethod
+    def get_dependencies(model_class):
+        return dict(
+            (definition, mutable_model_registry.get(definition)) for definition in model_class._dependencies
+        )
+
+    def is_current(self, entry, model_class, references):
+        if entry['references'] != references or entry['dependencies'] != self.get_dependencies(model_class):
+            return False
+        return all(
+            mutable_model_registry.get(definition) is related_model_class and not related_model_class._is_obsolete
+            for definition, related_model_class in entry['related_model_classes'].items()
+        )
+
+    def build_entry(self, model_class, state, references, previous):
+        app_label, model_name = state.app_label, state.name_lower
+        label = "%s.%s" % (app_label, model_name)
+        related_states = [
+            related_state for related_state in model_class.get_related_model_states(state)
+            if (related_state.app_label, related_state.name_lower) != (app_label, model_name)
+        ]
+        related_model_classes = {}
+        for related_state in related_states:
+            related_model_class = model_class._meta.apps.get_model(related_state.app_label, related_state.name)
+            if issubclass(related_model_class, MutableModel):
+                related_model_classes[related_model_class._definition] = related_model_class
+        if previous is not None and previous['related_states'] == related_states:
+            return dict(
+                previous, references=references, dependencies=self.get_dependencies(model_class),
+                related_model_classes=related_model_classes,
+            )
+        referenced = any(self.references(related_state, label) for related_state in related_states)
+        apps = None
+        if not referenced:
+            apps = StateApps([], {})
+            apps.render_multiple(related_states)
+        return {
+            'references': references,
+            'dependencies': self.get_dependencies(model_class),
+            'related_model_classes': related_model_classes,
+            'related_states': related_states,
+            'apps': apps,
+            'state': None,
+            'model': None,
+        }
+
+    def render(self, model_class, state):
+        key = model_class._definition
+        app_label, model_name = state.app_label, state.name_lower
+        references = self.get_references(state)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or not self.is_current(entry, model_class, references):
+                entry = self.build_entry(model_class, state, references, entry)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            if entry['state'] is not None and entry['state'] == state:
+                return entry['model']
+            apps = entry['apps']
+            with metrics.timer('model_state.render', model="%s.%s" % (app_label, state.name)):
+                if apps is None:
+                    # The relations of the models referencing this one must
+                    # point to its rendering; render them along with it.
+                    rendered_apps = StateApps([], {})
+                    rendered_apps.render_multiple(entry['related_states'] + [state.clone()])
+                    entry['model'] = rendered_apps.get_model(app_label, model_name)
+                else:
+                    # Unregister the previous rendering of the model.
+                    apps.all_models[app_label].pop(model_name, None)
+                    app_config = apps.app_configs.get(app_label)
+                    if app_config is not None:
+                        app_config.models.pop(model_name, None)
+                    apps.clear_cache()
+                    entry['model'] = state.clone().render(apps)
+            entry['state'] = state
+            return entry['model']
+
+    def discard(self, key):
+        """Discard the entry of `key` and the ones built from its model."""
+        with self.lock:
+            self.entries.pop(key, None)
+            for other_key, entry in list(self.entries.items()):
+                if key in entry['related_model_classes']:
+                    del self.entries[other_key]
+
+
+rendered_states = RenderedStateCache()
+
+
+class MutableModelRegistry(object):
+    """
+    In-memory registry of the current model class of each definition used to
+    resolve model classes and walk dependencies without hitting the database.
+
+    Lookups are performed against an immutable snapshot without acquiring any
+    lock while changes are applied to a copy of the snapshot that is swapped
+    in atomically. Every snapshot is tagged with an increasing version.
+
+    The registered model classes are also weakly referenced in order to keep
+    track of the versions still in use and their accesses are recorded,
+    without locking either, in order to determine the least recently used.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.snapshot = (0, {})
+        self.model_classes = WeakSet()
+        self.accesses = {}
+        self.ticks = count()
+
+    @property
+    def version(self):
+        return self.snapshot[0]
+
+    def _swap(self, update):
+        with self.lock:
+            version, models = self.snapshot
+            models = dict(models)
+            if update(models) is not False:
+                self.snapshot = (version + 1, models)
+
+    def register(self, model_class):
+        definition = model_class._definition
+
+        def update(models):
+            self.model_classes.add(model_class)
+            if models.get(definition) is model_class:
+                return False
+            models[definition] = model_class
+        self._swap(update)
+        self.touch(definition)
+
+    def unregister(self, model_class):
+        """Unregister `model_class` if it's the current one of its definition."""
+        definition = model_class._definition
+
+        def update(models):
+            if models.get(definition) is not model_class:
+                return False
+            del models[definition]
+            self.accesses.pop(definition, None)
+        self._swap(update)
+
+    def touch(self, definition):
+        self.accesses[definition] = next(self.ticks)
+
+    def __len__(self):
+        return len(self.snapshot[1])
+
+    def get_least_recently_used(self, size):
+        """
+        Return the least recently accessed model classes that exceed `size`
+        from the least to the most recently accessed.
+        """
+        models = self.snapshot[1]
+        if len(models) <= size:
+            return []
+        accesses = self.accesses
+        model_classes = sorted(models.values(), key=lambda model_class: accesses.get(model_class._definition, -1))
+        return model_classes[:len(models) - size]
+
+    def get(self, definition):
+        return self.snapshot[1].get(definition)
+
+    def get_versions(self, definition):
+        """
+        Return the model classes of `definition` that were registered and are
+        still referenced, obsolete ones included.
+        """
+        with self.lock:
+            return [model_class for model_class in self.model_classes if model_class._definition == definition]
+
+    def restore(self, snapshot):
+        with self.lock:
+            self.snapshot = (self.snapshot[0] + 1, snapshot[1])
+
+
+mutable_model_registry = MutableModelRegistry()
+
+
 class MutableModel(models.Model):
     """Abstract class used to identify models that we're created by a
     definition."""
@@ -29,10 +336,72 @@ class MutableModel(models.Model):
 
     @classmethod
     def is_obsolete(cls):
-        return (
-            cls._is_obsolete or
-            cls._checksum != state_handler.get_checksum(cls._definition[1])
-        )
+        """
+        Return whether or not the model class is obsolete.
+
+        Checksums retrieved from the state handler are trusted for
+        `MUTANT_STATE_STALENESS_WINDOW` seconds; changes made by other
+        processes might take that long to be noticed while local changes
+        are always noticed immediately.
+        """
+        if cls._is_obsolete:
+            return True
+        mutable_model_registry.touch(cls._definition)
+        now = time.time()
+        window = settings.STATE_STALENESS_WINDOW
+        if window and cls._is_checked(now, window):
+            checksum_lookups.avoided += 1
+            return False
+        checksum_lookups.performed += 1
+        if not window:
+            with metrics.timer('state_handler.get'):
+                checksum = state_handler.get_checksum(cls._definition[1])
+            return cls._checksum != checksum
+        # Check the related model classes that are likely to be accessed
+        # next along with this one.
+        model_classes = [cls] + [
+            model_class for model_class in cls._get_related_mutable_models()
+            if not model_class._is_obsolete and not model_class._is_checked(now, window)
+        ]
+        with metrics.timer('state_handler.get'):
+            checksums = state_handler.get_many_checksums(
+                [model_class._definition[1] for model_class in model_classes]
+            )
+        for model_class in model_classes:
+            if model_class._checksum == checksums.get(model_class._definition[1]):
+                model_class._checksum_checked_at = now
+        return cls._checksum_checked_at != now
+
+    @classmethod
+    def _is_checked(cls, now, window):
+        checked_at = cls._checksum_checked_at
+        return checked_at is not None and 0 <= now - checked_at < window
+
+    @classmethod
+    def _get_related_mutable_models(cls):
+        """
+        Return the loaded model classes of the mutable bases and related
+        mutable models of this model class and of their own related models.
+        """
+        related_models = []
+        seen = set([cls._definition])
+        pending = [cls]
+        while pending:
+            model_class = pending.pop()
+            opts = model_class._meta
+            candidates = list(opts.get_parent_list()) + [
+                get_remote_field_model(field) for field in opts.fields + opts.many_to_many if field.is_relation
+            ]
+            for candidate in candidates:
+                if (not isinstance(candidate, type) or not issubclass(candidate, MutableModel) or
+                        candidate._meta.abstract or candidate._definition in seen):
+                    continue
+                seen.add(candidate._definition)
+                related_model = mutable_model_registry.get(candidate._definition)
+                if related_model is not None:
+                    related_models.append(related_model)
+                    pending.append(related_model)
+        return related_models
 
     @classmethod
     def get_model_state(cls, **kwargs):
@@ -40,66 +409,141 @@ class MutableModel(models.Model):
 
     @classmethod
     def get_related_model_states(cls, model_state):
+        """
+        Return the states required to render `model_state`: the ones of the
+        models it's related to, without their relations, and the ones of the
+        models with relations to it in order for its reverse relations to be
+        available to schema alterations.
+        """
         model_states = {}
+
+        def add_model_state(model):
+            if issubclass(model, MutableModel):
+                state = model.get_model_state(exclude_rels=True)
+            else:
+                state = ModelState.from_model(model, exclude_rels=True)
+            state = model_states.setdefault((state.app_label, state.name), state)
+            for base in state.bases:
+                if isinstance(base, string_types):
+                    add_model_state(cls._meta.apps.get_model(base))
+            return state
+
         for _name, field in model_state.fields:
             related_model_reference = get_remote_field_model(field)
             if related_model_reference:
-                related_model = cls._meta.apps.get_model(related_model_reference)
-                if issubclass(related_model, MutableModel):
-                    related_model_state = related_model.get_model_state(exclude_rels=True)
-                else:
-                    related_model_state = ModelState.from_model(related_model, exclude_rels=True)
-                model_states[related_model_state.app_label, related_model_state.name] = related_model_state
-                for base in related_model_state.bases:
-                    if isinstance(base, string_types):
-                        base_model = cls._meta.apps.get_model(base)
-                        if issubclass(base_model, MutableModel):
-                            base_model_state = base_model.get_model_state(exclude_rels=True)
-                        else:
-                            base_model_state = ModelState.from_model(base_model, exclude_rels=True)
-                        model_states[base_model_state.app_label, base_model_state.name] = base_model_state
+                add_model_state(cls._meta.apps.get_model(related_model_reference))
+        # The loaded model classes of dependent definitions might still refer
+        # to a previous version of this model class; match them by label.
+        label = "%s.%s" % (model_state.app_label, model_state.name_lower)
+        fields = [rel.field for rel in cls._meta._get_fields(forward=False, reverse=True, include_hidden=True)]
+        for definition in cls._dependencies:
+            dependency = mutable_model_registry.get(definition)
+            if dependency is not None:
+                fields.extend(dependency._meta.local_fields + dependency._meta.local_many_to_many)
+        seen = set()
+        for field in fields:
+            related_opts = field.model._meta
+            remote_field = get_remote_field(field)
+            if (remote_field is None or isinstance(remote_field.model, string_types) or
+                    remote_field.model._meta.label_lower != label or related_opts.label_lower == label or
+                    related_opts.auto_created or remote_field.parent_link or
+                    field not in related_opts.local_fields + related_opts.local_many_to_many or
+                    (field.many_to_many and not remote_field.through._meta.auto_created) or
+                    (related_opts.label_lower, field.name) in seen):
+                continue
+            seen.add((related_opts.label_lower, field.name))
+            related_model_state = add_model_state(field.model)
+            related_model_state.fields.append((field.name, field.clone()))
         return list(model_states.values())
 
     @classmethod
     def render_state(cls):
-        state = cls.get_model_state()
-        related_states = cls.get_related_model_states(state)
-        apps = StateApps([], {})
-        apps.render_multiple(related_states + [state])
-        return apps.all_models[state.app_label][state.name.lower()]
+        return rendered_states.render(cls, cls.get_model_state())
 
     @classmethod
-    def mark_as_obsolete(cls, origin=None):
+    def mark_as_obsolete(cls):
+        """
+        Mark the model class and the loaded model classes depending on it as
+        obsolete. Dependencies are rebuilt lazily on their next access.
+        """
         cls._is_obsolete = True
+        metrics.increment('model_class.obsolete', definition=cls._definition[1])
+        model_resolution_cache.invalidate(cls._definition[1])
         logger.debug(
             "Marking model %s and it dependencies (%s) as obsolete.",
             cls, cls._dependencies
         )
-        if origin is None:
-            origin = cls._definition
-        for definition_cls, definition_pk in cls._dependencies:
-            if (definition_cls, definition_pk) == origin:
-                continue
-            try:
-                definition = definition_cls.objects.get(pk=definition_pk)
-            except definition_cls.DoesNotExist:
-                pass
-            else:
-                definition.model_class().mark_as_obsolete(origin)
+        for definition in cls._dependencies:
+            dependency = mutable_model_registry.get(definition)
+            # Skipping obsolete dependencies prevents infinite recursion when
+            # model classes depend on each other.
+            if dependency is not None and not dependency._is_obsolete:
+                dependency.mark_as_obsolete()
 
     def clean(self):
         if self.is_obsolete():
             raise ValidationError('Obsolete definition')
         return super(MutableModel, self).clean()
 
+    @classmethod
+    def get_current_model_class(cls):
+        model_class = mutable_model_registry.get(cls._definition)
+        if model_class is None or model_class.is_obsolete():
+            model_class = cls.definition().model_class().model
+        return model_class
+
+    def rebind(self, field_names=None):
+        """
+        Rebind this instance of an obsolete model class to the current model
+        class of its definition and return the names of the fields it can
+        write. Raise a `ValidationError` if the primary key or the columns of
+        the fields named `field_names`, all of them by default, changed.
+        """
+        opts = self._meta
+        if field_names is None:
+            fields = opts.concrete_fields
+        else:
+            # Fields can be referred to by their name or attname, unknown ones
+            # are left to `Model.save()` to report.
+            concrete_fields = {}
+            for field in opts.concrete_fields:
+                concrete_fields[field.name] = concrete_fields[field.attname] = field
+            fields = [opts.pk] + [concrete_fields[name] for name in field_names if name in concrete_fields]
+        model_class = self.get_current_model_class()
+        current_opts = model_class._meta
+        for field in fields:
+            try:
+                current_field = current_opts.get_field(field.name)
+            except FieldDoesNotExist:
+                current_field = None
+            if (current_field is None or not current_field.concrete or current_field.column != field.column or
+                    current_field.deconstruct()[1:] != field.deconstruct()[1:]):
+                msg = _('Cannot rebind an obsolete model, its %s field changed.')
+                raise ValidationError(msg % field.name)
+        if self._state.adding:
+            # Columns added in the meantime must be assigned their default.
+            for field in current_opts.concrete_fields:
+                if field.attname not in self.__dict__:
+                    setattr(self, field.attname, field.get_default())
+        self.__class__ = model_class
+        return [field.name for field in fields if not field.primary_key]
+
     def save(self, *args, **kwargs):
         if self.is_obsolete():
-            msg = _('Cannot save an obsolete model')
-            raise ValidationError(msg)
+            if not settings.REBIND_OBSOLETE_INSTANCES:
+                msg = _('Cannot save an obsolete model')
+                raise ValidationError(msg)
+            update_fields = kwargs.get('update_fields')
+            field_names = self.rebind(update_fields)
+            # Only write the columns known to the obsolete model class.
+            if update_fields is None and not self._state.adding:
+                kwargs['update_fields'] = field_names
         return super(MutableModel, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         if self.is_obsolete():
-            msg = _('Cannot delete an obsolete model')
-            raise ValidationError(msg)
+            if not settings.REBIND_OBSOLETE_INSTANCES:
+                msg = _('Cannot delete an obsolete model')
+                raise ValidationError(msg)
+            self.rebind([])
         return super(MutableModel, self).delete(*args, **kwargs)
@@ -1,23 +1,210 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
+from threading import local
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import connections, models, transaction
 from django.db.models.fields import FieldDoesNotExist
 
 from ..compat import get_remote_field
+from ..db.models import mutable_model_registry, rendered_states
+from ..metrics import metrics
 from ..state import handler as state_handler
 from ..utils import allow_migrate, popattr, remove_from_app_cache
 
 
+class SchemaAlteration(local):
+    """
+    Thread local state of deferred model class rebuilds and schema alterations.
+
+    While rebuilds are deferred, the model classes of altered definitions are
+    only rebuilt once the outermost `defer_rebuilds()` block exits. DDL
+    operations are performed against a model rendered from a per definition
+    state that is updated as operations are performed (or queued by
+    `bulk_alter()`) in order to reflect the table they are applied to.
+    """
+
+    def __init__(self):
+        self.deferring = 0
+        self.queueing = 0
+        self.operations = []
+        self.reset()
+
+    def reset(self):
+        self.states = {}
+        self.models = {}
+        self.definitions = OrderedDict()
+
+    @property
+    def active(self):
+        return self.deferring > 0
+
+    def get_state(self, definition):
+        try:
+            state = self.states[definition.pk]
+        except KeyError:
+            model_class = definition.model_class().model
+            state = self.states[definition.pk] = model_class.get_model_state()
+            self.models[definition.pk] = (model_class, None)
+        return state
+
+    def get_model(self, definition):
+        """Render the model class reflecting the performed operations."""
+        state = self.get_state(definition)
+        model_class, rendered = self.models[definition.pk]
+        if rendered is None:
+            rendered = rendered_states.render(model_class, state.clone())
+            self.models[definition.pk] = (model_class, rendered)
+        return rendered
+
+    def update_state(self, definition, remove=None, add=None, **options):
+        state = self.get_state(definition)
+        fields = state.fields
+        if remove is not None:
+            fields = [(name, field) for name, field in fields if name != remove]
+        if add is not None:
+            fields.append((add.name, add.clone()))
+        state.fields = fields
+        state.options.update(options)
+        model_class, _rendered = self.models[definition.pk]
+        self.models[definition.pk] = (model_class, None)
+
+    def queue(self, action, model, args, kwargs):
+        for alias in allow_migrate(model):
+            self.operations.append((alias, action, model, args, kwargs))
+
+    def apply(self):
+        operations, self.operations = self.operations, []
+        aliases = OrderedDict()
+        for alias, action, model, args, kwargs in operations:
+            aliases.setdefault(alias, []).append((action, model, args, kwargs))
+        for alias, alias_operations in aliases.items():
+            connection = connections[alias]
+            with transaction.atomic(alias), connection.schema_editor() as editor:
+                for action, model, args, kwargs in alias_operations:
+                    with metrics.timer('schema.ddl', operation=action):
+                        getattr(editor, action)(model, *args, **kwargs)
+
+    def defer_rebuild(self, definition):
+        self.definitions.setdefault(definition.pk, definition)
+
+    def rebuild(self):
+        definitions = self.definitions
+        self.reset()
+        for definition in definitions.values():
+            definition.refresh_revision()
+            definition.model_class(force_create=True)
+
+    def checkpoint(self):
+        """Record the tracked alterations in order to `discard()` the ones
+        performed afterwards."""
+        return len(self.definitions), dict(self.models)
+
+    def discard(self, checkpoint=(0, {})):
+        """Stop tracking the definitions altered since `checkpoint`, all of
+        them by default, and mark their model classes as obsolete in order
+        for them to be lazily rebuilt from the database."""
+        count, models = checkpoint
+        altered = [pk for pk, entry in self.models.items() if models.get(pk) is not entry]
+        altered.extend(pk for pk in list(self.definitions)[count:] if pk not in altered)
+        for pk in altered:
+            self.states.pop(pk, None)
+            entry = self.models.pop(pk, None)
+            definition = self.definitions.pop(pk, None)
+            model_class = entry[0] if entry else ContentType.model_class(definition)
+            if model_class is not None:
+                model_class.mark_as_obsolete()
+
+
+schema_alteration = SchemaAlteration()
+
+
+@contextmanager
+def defer_rebuilds():
+    """
+    Coalesce the model class rebuilds, and the checksum publications they
+    trigger, of the definitions altered in the block into a single one per
+    definition performed when the outermost block exits.
+
+    Model classes retrieved within the block don't reflect the alterations
+    performed in it.
+    """
+    checkpoint = schema_alteration.checkpoint()
+    schema_alteration.deferring += 1
+    try:
+        yield
+    except BaseException:
+        # The states altered in the block might not reflect the database
+        # anymore while the ones altered by enclosing blocks still do.
+        schema_alteration.discard(checkpoint)
+        raise
+    finally:
+        schema_alteration.deferring -= 1
+    if not schema_alteration.active:
+        schema_alteration.rebuild()
+
+
+@contextmanager
+def bulk_alter(using=None):
+    """
+    Defer the schema alterations and model class rebuilds triggered by the
+    definition changes performed in the block until it exits.
+
+    All the queued DDL operations are then executed in a single schema editor
+    session per database and each altered definition is rebuilt once.
+    """
+    with defer_rebuilds(), transaction.atomic(using):
+        queued = len(schema_alteration.operations)
+        schema_alteration.queueing += 1
+        try:
+            yield
+        except BaseException:
+            # The savepoint of the block is rolled back along with the
+            # definition changes that queued these operations.
+            del schema_alteration.operations[queued:]
+            raise
+        finally:
+            schema_alteration.queueing -= 1
+        if not schema_alteration.queueing:
+            schema_alteration.apply()
+
+
+def get_altered_model(definition):
+    """Return the model class DDL operations should be performed against."""
+    if schema_alteration.active:
+        return schema_alteration.get_model(definition)
+    return definition.model_class().render_state()
+
+
+def evict_content_type(content_type_id, *natural_keys):
+    """
+    Evict a content type from the cache of `ContentType.objects` by id and
+    natural keys instead of clearing it entirely.
+    """
+    for cache in list(ContentType.objects._cache.values()):
+        keys = set(natural_keys)
+        content_type = cache.pop(content_type_id, None)
+        if content_type is not None:
+            keys.add((content_type.app_label, content_type.model))
+        for key in keys:
+            cache.pop(key, None)
+
+
 def perform_ddl(action, model, *args, **kwargs):
     if model._meta.managed:
         return
 
+    if schema_alteration.queueing:
+        schema_alteration.queue(action, model, args, kwargs)
+        return
+
     for alias in allow_migrate(model):
         connection = connections[alias]
-        with transaction.atomic(alias), connection.schema_editor() as editor:
+        with transaction.atomic(alias), connection.schema_editor() as editor, \
+                metrics.timer('schema.ddl', operation=action):
             getattr(editor, action)(model, *args, **kwargs)
 
 
@@ -35,8 +222,25 @@ def nonraw_instance(receiver):
     return wrapper
 
 
+def raw_model_definition_pre_save(sender, instance, raw, using, **kwargs):
+    """
+    Prevent definitions loaded from fixtures from rewinding their stored
+    revision which would make their checksum collide with a previous one.
+    """
+    if raw:
+        revision = sender._default_manager.using(using).filter(pk=instance.pk).values_list(
+            'revision', flat=True
+        ).first()
+        if revision is not None and revision > instance.revision:
+            instance.revision = revision
+
+
 @nonraw_instance
-def model_definition_post_save(sender, instance, created, **kwargs):
+def model_definition_post_save(sender, instance, created, raw, **kwargs):
+    # Definitions loaded from fixtures are not passing through
+    # `ModelDefinition.save()`.
+    if raw:
+        instance.bump_revision()
     model_class = instance.model_class(force_create=True)
     opts = model_class._meta
     db_table = opts.db_table
@@ -79,12 +283,15 @@ def model_definition_post_save(sender, instance, created, **kwargs):
             old_db_table = old_model_class._meta.db_table
             if db_table != old_db_table:
                 perform_ddl('alter_db_table', model_class, old_db_table, db_table)
-            ContentType.objects.clear_cache()
+            old_opts = old_model_class._meta
+            evict_content_type(instance.pk, (old_opts.app_label, old_opts.model_name))
     instance._model_class = model_class.model
 
 
 def model_definition_pre_delete(sender, instance, **kwargs):
-    model_class = instance.model_class()
+    # Keep a reference to the model class itself since the proxy would fail
+    # to resolve it if it's marked as obsolete once the definition is deleted.
+    model_class = instance.model_class().model
     instance._state._deletion = (
         model_class,
         instance.pk,
@@ -94,17 +301,21 @@ def model_definition_pre_delete(sender, instance, **kwargs):
 def model_definition_post_delete(sender, instance, **kwargs):
     model_class, pk = popattr(instance._state, '_deletion')
     perform_ddl('delete_model', model_class)
+    rendered_states.discard(model_class._definition)
     remove_from_app_cache(model_class)
     model_class.mark_as_obsolete()
+    for version in mutable_model_registry.get_versions(model_class._definition):
+        if not version._is_obsolete:
+            version.mark_as_obsolete()
     state_handler.clear_checksum(pk)
-    ContentType.objects.clear_cache()
+    evict_content_type(pk)
     del instance._model_class
 
 
 def base_definition_post_save(sender, instance, created, raw, **kwargs):
     declared_fields = instance.get_declared_fields()
     if declared_fields:
-        model_class = instance.model_def.model_class().render_state()
+        model_class = get_altered_model(instance.model_def)
         opts = model_class._meta
         if created:
             add_columns = popattr(instance._state, '_add_columns', True)
@@ -117,8 +328,12 @@ def base_definition_post_save(sender, instance, created, raw, **kwargs):
                         auto_pk = False
                         field.primary_key = True
                         perform_ddl('alter_field', model_class, opts.pk, field, strict=True)
+                        if schema_alteration.active:
+                            schema_alteration.update_state(instance.model_def, remove=opts.pk.name, add=field)
                     else:
                         perform_ddl('add_field', model_class, field)
+                        if schema_alteration.active:
+                            schema_alteration.update_state(instance.model_def, add=field)
         else:
             for field in declared_fields:
                 try:
@@ -127,6 +342,8 @@ def base_definition_post_save(sender, instance, created, raw, **kwargs):
                     perform_ddl('add_field', model_class, field)
                 else:
                     perform_ddl('alter_field', model_class, old_field, field, strict=True)
+                if schema_alteration.active:
+                    schema_alteration.update_state(instance.model_def, remove=field.name, add=field)
 
 
 def base_definition_pre_delete(sender, instance, **kwargs):
@@ -142,7 +359,7 @@ def base_definition_pre_delete(sender, instance, **kwargs):
         return
     if (instance.base and issubclass(instance.base, models.Model) and
             instance.base._meta.abstract):
-        instance._state._deletion = instance.model_def.model_class().render_state()
+        instance._state._deletion = get_altered_model(instance.model_def)
 
 
 def base_definition_post_delete(sender, instance, **kwargs):
@@ -155,18 +372,43 @@ def base_definition_post_delete(sender, instance, **kwargs):
         model = popattr(instance._state, '_deletion')
         for field in instance.base._meta.fields:
             perform_ddl('remove_field', model, field)
+            if schema_alteration.active:
+                schema_alteration.update_state(instance.model_def, remove=field.name)
 
 
 def unique_together_field_defs_changed(instance, action, model, **kwargs):
-    model_class = instance.model_def.model_class()
+    model_def = instance.model_def
+    if schema_alteration.active:
+        model_class = schema_alteration.get_model(model_def)
+    else:
+        model_class = model_def.model_class()
     if action.startswith('post_'):
+        unique_together = model_def.get_state().options.get('unique_together', [])
         perform_ddl(
             'alter_unique_together',
             model_class,
             model_class._meta.unique_together,
-            instance.model_def.get_state().options.get('unique_together', [])
+            unique_together
         )
-        model_class.mark_as_obsolete()
+        model_def.bump_revision()
+        if schema_alteration.active:
+            schema_alteration.update_state(model_def, unique_together=unique_together)
+            schema_alteration.defer_rebuild(model_def)
+        else:
+            model_class.mark_as_obsolete()
+
+
+def raw_definition_attribute_post_save(sender, instance, raw, **kwargs):
+    """
+    Definition attributes loaded from fixtures are not passing through
+    `ModelDefinitionAttribute.save()`. Make sure the revision of their
+    definition is bumped in order to invalidate its model classes.
+    """
+    if raw:
+        field_def = getattr(instance, 'field_def', None)
+        model_def = (field_def or instance).model_def
+        model_def.bump_revision()
+        model_def.model_class().mark_as_obsolete()
 
 
 def raw_field_definition_proxy_post_save(sender, instance, raw, **kwargs):
@@ -191,7 +433,7 @@ def field_definition_post_save(sender, instance, created, raw, **kwargs):
     This signal is connected by all FieldDefinition subclasses
     see comment in FieldDefinitionBase for more details
     """
-    model_class = instance.model_def.model_class().render_state()
+    model_class = get_altered_model(instance.model_def)
     field = instance.construct_for_migrate()
     field.model = model_class
     if created:
@@ -201,14 +443,24 @@ def field_definition_post_save(sender, instance, created, raw, **kwargs):
         add_column = popattr(instance._state, '_add_column', True)
         if add_column:
             perform_ddl('add_field', model_class, field)
+            if schema_alteration.active:
+                schema_alteration.update_state(instance.model_def, add=field)
             # If the field definition is raw we must re-create the model class
             # since ModelDefinitionAttribute.save won't be called
             if raw:
+                instance.model_def.bump_revision()
                 instance.model_def.model_class().mark_as_obsolete()
+    elif raw:
+        # Raw updates don't go through FieldDefinition.save() and thus the
+        # previous state of the field is unknown.
+        instance.model_def.bump_revision()
+        instance.model_def.model_class().mark_as_obsolete()
     else:
         old_field = instance._state._pre_save_field
         delattr(instance._state, '_pre_save_field')
         perform_ddl('alter_field', model_class, old_field, field, strict=True)
+        if schema_alteration.active:
+            schema_alteration.update_state(instance.model_def, remove=old_field.name, add=field)
 
 FIELD_DEFINITION_POST_SAVE_UID = "mutant.management.%s_post_save"
 
@@ -220,7 +472,10 @@ def field_definition_pre_delete(sender, instance, **kwargs):
     )
     if cascade_deletion_origin == 'model_def':
         return
-    model_class = instance.model_def.model_class()
+    if schema_alteration.active:
+        model_class = schema_alteration.get_model(instance.model_def)
+    else:
+        model_class = instance.model_def.model_class()
     opts = model_class._meta
     field = opts.get_field(instance.name)
     instance._state._deletion = (model_class, field)
@@ -232,5 +487,9 @@ def field_definition_post_delete(sender, instance, **kwargs):
         if field.primary_key:
             primary_key = models.AutoField(name='id', primary_key=True)
             perform_ddl('alter_field', model, field, primary_key, strict=True)
+            if schema_alteration.active:
+                schema_alteration.update_state(instance.model_def, remove=field.name, add=primary_key)
         else:
             perform_ddl('remove_field', model, field)
+            if schema_alteration.active:
+                schema_alteration.update_state(instance.model_def, remove=field.name)
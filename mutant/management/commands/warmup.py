@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...models import ModelDefinition
+
+
+class Command(BaseCommand):
+    """
+    Construct the model classes of all definitions in bulk and publish their
+    checksums to the configured state handler.
+    """
+    help = 'Constructs the model classes of all model definitions in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'app_label', nargs='*',
+            help='Restricts the model definitions to warm up to the specified app labels.'
+        )
+
+    def handle(self, *app_labels, **options):
+        app_labels = app_labels or options.get('app_label')
+        model_defs = ModelDefinition.objects.all()
+        if app_labels:
+            model_defs = model_defs.filter(app_label__in=app_labels)
+        timings = model_defs.warm_up()
+        for phase, duration in timings.items():
+            self.stdout.write("%s: %.3fs" % (phase, duration))
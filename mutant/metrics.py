@@ -0,0 +1,98 @@
+from __future__ import unicode_literals
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from django.apps import apps
+
+
+class NullMetrics(object):
+    """
+    Metrics backend discarding everything it's reported. Subclasses should
+    override `timing()` and `increment()` to export metrics.
+
+    The following metrics are reported, durations are in seconds:
+
+    - `model_class.construct` timing tagged with `definition`
+    - `model_state.render` timing tagged with `model`
+    - `checksum.compute` timing tagged with `definition`
+    - `state_handler.get` and `state_handler.set` timings
+    - `schema.ddl` timing tagged with `operation`
+    - `model_class.obsolete` count tagged with `definition`
+    - `model_class.evicted` count tagged with `definition`
+    """
+
+    def timing(self, name, duration, **tags):
+        pass
+
+    def increment(self, name, value=1, **tags):
+        pass
+
+    @contextmanager
+    def timer(self, name, **tags):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start, **tags)
+
+
+class MemoryMetrics(NullMetrics):
+    """
+    Metrics backend keeping reported values in memory, mostly useful for
+    testing and debugging purposes.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = defaultdict(list)
+            self.counters = defaultdict(int)
+
+    def _get_key(self, name, tags):
+        return name, tuple(sorted(tags.items()))
+
+    def _matches(self, key, name, tags):
+        return key[0] == name and set(tags.items()).issubset(key[1])
+
+    def timing(self, name, duration, **tags):
+        with self.lock:
+            self.timings[self._get_key(name, tags)].append(duration)
+
+    def increment(self, name, value=1, **tags):
+        with self.lock:
+            self.counters[self._get_key(name, tags)] += value
+
+    def get_timings(self, name, **tags):
+        """Return the durations reported for `name` with matching `tags`."""
+        with self.lock:
+            return [
+                duration for key, durations in self.timings.items() if self._matches(key, name, tags)
+                for duration in durations
+            ]
+
+    def get_count(self, name, **tags):
+        """Return the sum of the counts reported for `name` with matching `tags`."""
+        with self.lock:
+            return sum(
+                count for key, count in self.counters.items() if self._matches(key, name, tags)
+            )
+
+
+null_metrics = NullMetrics()
+
+
+class MetricsProxy(object):
+    def __getattribute__(self, name):
+        backend = null_metrics
+        if apps.apps_ready:
+            backend = getattr(apps.get_app_config('mutant'), 'metrics', null_metrics)
+        return getattr(backend, name)
+
+
+metrics = MetricsProxy()
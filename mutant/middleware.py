@@ -0,0 +1,23 @@
+from __future__ import unicode_literals
+
+from .compat import MiddlewareMixin
+from .db.models import cache_model_resolution, model_resolution_cache
+
+
+class ModelResolutionCacheMiddleware(MiddlewareMixin):
+    """
+    Cache the model classes resolved by mutable model proxies for the
+    duration of each request.
+    """
+
+    def __call__(self, request):
+        with cache_model_resolution():
+            return self.get_response(request)
+
+    # Hooks used when installed in the legacy MIDDLEWARE_CLASSES setting.
+    def process_request(self, request):
+        model_resolution_cache.enable()
+
+    def process_response(self, request, response):
+        model_resolution_cache.disable()
+        return response
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutant', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modeldefinition',
+            name='revision',
+            field=models.PositiveIntegerField(default=0, verbose_name='revision', editable=False),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutant', '0002_modeldefinition_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChecksumChange',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('definition_pk', models.PositiveIntegerField(verbose_name='definition pk', db_index=True)),
+                ('checksum', models.CharField(max_length=32, null=True, verbose_name='checksum')),
+            ],
+            options={
+                'verbose_name': 'checksum change',
+                'verbose_name_plural': 'checksum changes',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutant', '0003_checksumchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checksumchange',
+            name='compacted_at',
+            field=models.DateTimeField(null=True, verbose_name='compacted at', db_index=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mutant', '0004_checksumchange_compacted_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checksumchange',
+            name='revision',
+            field=models.BigIntegerField(null=True, verbose_name='revision'),
+        ),
+        migrations.AddField(
+            model_name='checksumchange',
+            name='node',
+            field=models.CharField(max_length=32, null=True, verbose_name='node'),
+        ),
+    ]
@@ -1,2 +1,3 @@
 from .field import *  # NOQA
 from .model import *  # NOQA
+from .state import *  # NOQA
@@ -4,7 +4,7 @@ import warnings
 
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.db import models
+from django.db import models, router, transaction
 from django.db.models import signals
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
@@ -15,6 +15,7 @@ from polymodels.utils import copy_fields
 from ...db.fields import (
     FieldDefinitionTypeField, LazilyTranslatedField, PythonIdentifierField,
 )
+from ...management import schema_alteration
 from ...utils import lazy_string_format, popattr
 from ..model import ModelDefinitionAttribute
 from ..ordered import OrderedModel
@@ -278,7 +279,10 @@ class FieldDefinition(six.with_metaclass(FieldDefinitionBase, BasePolymorphicMod
         return instance
 
     def get_bound_field(self):
-        opts = self.model_def.model_class()._meta
+        if schema_alteration.active:
+            opts = schema_alteration.get_model(self.model_def)._meta
+        else:
+            opts = self.model_def.model_class()._meta
         for field in opts.fields:
             if field.name == self._saved_name:
                 return field
@@ -339,10 +343,23 @@ class FieldDefinitionChoice(OrderedModel):
             raise ValidationError({'value': e.messages})
 
     def save(self, *args, **kwargs):
-        save = super(FieldDefinitionChoice, self).save(*args, **kwargs)
-        self.field_def.model_def.model_class(force_create=True)
+        model_def = self.field_def.model_def
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            save = super(FieldDefinitionChoice, self).save(*args, **kwargs)
+            model_def.bump_revision()
+        model_def.rebuild_model_class()
         return save
 
+    def delete(self, *args, **kwargs):
+        model_def = self.field_def.model_def
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            delete = super(FieldDefinitionChoice, self).delete(*args, **kwargs)
+            model_def.bump_revision()
+        model_def.rebuild_model_class()
+        return delete
+
     def get_ordering_queryset(self):
         qs = super(FieldDefinitionChoice, self).get_ordering_queryset()
         return qs.filter(field_def_id=self.field_def_id)
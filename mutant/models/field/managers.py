@@ -24,6 +24,10 @@ class FieldDefinitionManager(PolymorphicManager.from_queryset(FieldDefinitionQue
 
     def names(self):
         qs = self.get_queryset()
+        if qs._result_cache is not None:
+            # Avoid hitting the database if the field definitions were
+            # prefetched.
+            return sorted(field_def.name for field_def in qs)
         return qs.order_by('name').values_list('name', flat=True)
 
     def create_with_default(self, default, **kwargs):
@@ -35,9 +39,14 @@ class FieldDefinitionChoiceQuerySet(models.query.QuerySet):
     def construct(self):
         # Here we don't use .values() since it's raw output from the database
         # and values are not prepared correctly.
+        if self._result_cache is None:
+            queryset = self.only('group', 'value', 'label')
+        else:
+            # Choices were prefetched.
+            queryset = self
         choices = (
             {'group': choice.group, 'label': choice.label, 'value': choice.value}
-            for choice in self.only('group', 'value', 'label')
+            for choice in queryset
         )
         return tuple(choices_from_dict(choices))
 
@@ -1,37 +1,172 @@
 from __future__ import unicode_literals
 
-import pickle
+import logging
+from contextlib import contextmanager
+from functools import partial
 from hashlib import md5
+from threading import Lock, local
 
 import django
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, router, transaction
 from django.db.migrations.state import ModelState
+from django.db.models import Prefetch
 from django.db.models.constants import LOOKUP_SEP
 from django.db.models.fields import FieldDoesNotExist
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import force_bytes, python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from picklefield.fields import PickledObjectField
 
-from ... import logger
-from ...compat import get_opts_label, get_remote_field, get_remote_field_model
+from ... import logger, settings
+from ...compat import (
+    get_opts_label, get_remote_field, get_remote_field_model,
+    prefetch_related_objects,
+)
 from ...db.deletion import CASCADE_MARK_ORIGIN
 from ...db.fields import LazilyTranslatedField, PythonIdentifierField
-from ...db.models import MutableModel
+from ...db.models import (
+    MutableModel, model_resolution_cache, mutable_model_registry,
+    rendered_states,
+)
+from ...management import schema_alteration
+from ...metrics import metrics
 from ...signals import mutable_class_prepared
 from ...state import handler as state_handler
-from ...utils import get_db_table, get_foward_fields, remove_from_app_cache
+from ...utils import (
+    SingleFlight, expire_related_caches, get_db_table, get_foward_fields,
+    get_model_class_size, remove_from_app_cache, targeted_cache_expiry,
+)
 from ..ordered import OrderedModel
 from .managers import ModelDefinitionManager
 
 
+class _ModelClassConstruction(local):
+    deferred = False
+
+_model_class_construction = _ModelClassConstruction()
+
+model_class_constructions = SingleFlight()
+
+_model_class_eviction_lock = Lock()
+
+
+def _get_eviction_group(model_class):
+    """
+    Return the loaded model classes related to `model_class`, directly or
+    through other loaded model classes, along with `model_class` itself or
+    `None` if one of them is related to a model that isn't mutable.
+    """
+    group = {model_class._definition: model_class}
+    pending = [model_class]
+    while pending:
+        current = pending.pop()
+        opts = current._meta
+        definitions = set(current._dependencies)
+        candidates = list(opts.get_parent_list()) + [
+            get_remote_field_model(field) for field in opts.fields + opts.many_to_many if field.is_relation
+        ]
+        for candidate in candidates:
+            if not isinstance(candidate, type):
+                continue
+            if not issubclass(candidate, MutableModel):
+                return None
+            definitions.add(candidate._definition)
+        for definition in definitions:
+            related_model = mutable_model_registry.get(definition)
+            if related_model is not None and definition not in group:
+                group[definition] = related_model
+                pending.append(related_model)
+    return list(group.values())
+
+
+def evict_model_classes(size):
+    """
+    Evict the least recently used mutable model classes until at most `size`
+    of them are loaded and return them. Evicted model classes are removed
+    from the app registry in order to be lazily reconstructed on the next
+    access of their definition. They are not marked as obsolete and their
+    existing instances remain usable.
+
+    Model classes are evicted along with the loaded model classes they are
+    related to, which are rebuilt together, and the ones related to models
+    that are not mutable are never evicted as their reverse relations would
+    be lost.
+    """
+    evicted = []
+    with _model_class_eviction_lock:
+        for candidate in mutable_model_registry.get_least_recently_used(0):
+            if len(mutable_model_registry) <= size:
+                break
+            if mutable_model_registry.get(candidate._definition) is not candidate:
+                continue
+            group = _get_eviction_group(candidate)
+            if group is None:
+                continue
+            for model_class in group:
+                definition_pk = model_class._definition[1]
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        "Evicting model class %s retaining approximately %d bytes.",
+                        model_class, get_model_class_size(model_class)
+                    )
+                remove_from_app_cache(model_class, quiet=True)
+                rendered_states.discard(model_class._definition)
+                model_resolution_cache.invalidate(definition_pk)
+                metrics.increment('model_class.evicted', definition=definition_pk)
+                evicted.append(model_class)
+    return evicted
+
+
+@contextmanager
+def _set_model_class_construction_deferral(deferred):
+    previous = _model_class_construction.deferred
+    _model_class_construction.deferred = deferred
+    try:
+        yield
+    finally:
+        _model_class_construction.deferred = previous
+
+
+def defer_model_class_construction():
+    """
+    Prevent model definitions retrieved from the database from eagerly
+    constructing their model class on initialization and mutable bases from
+    being resolved when unpickled.
+    """
+    return _set_model_class_construction_deferral(True)
+
+
+def _resolve_model_class():
+    return _set_model_class_construction_deferral(False)
+
+
+class DeferredModelClass(object):
+    """
+    Reference to the model class of a definition unpickled while model class
+    construction is deferred.
+    """
+
+    def __init__(self, definition_cls, definition_pk):
+        self.definition_cls = definition_cls
+        self.definition_pk = definition_pk
+
+    def __reduce_ex__(self, protocol):
+        return (_model_class_from_pk, (self.definition_cls, self.definition_pk))
+
+    def resolve(self):
+        with _resolve_model_class():
+            return _model_class_from_pk(self.definition_cls, self.definition_pk)
+
+
 def _model_class_from_pk(definition_cls, definition_pk):
     """
     Helper used to unpickle MutableModel model class from their definition
     pk.
     """
+    if _model_class_construction.deferred:
+        return DeferredModelClass(definition_cls, definition_pk)
     try:
         return definition_cls.objects.get(pk=definition_pk).model_class()
     except definition_cls.DoesNotExist:
@@ -81,7 +216,18 @@ class MutableModelProxy(object):
 
     def __get__(self, instance=None, owner=None):
         model = self.model
-        if not self.refreshing and model.is_obsolete():
+        if self.refreshing:
+            return model
+        definition_pk = model._definition[1]
+        resolved = model_resolution_cache.get(definition_pk)
+        if resolved is not None and not resolved._is_obsolete:
+            # Keep track of the accesses the least recently used model
+            # classes eviction relies on.
+            mutable_model_registry.touch(resolved._definition)
+            if resolved is not model:
+                super(MutableModelProxy, self).__setattr__('model', resolved)
+            return resolved
+        if model.is_obsolete():
             supset = super(MutableModelProxy, self).__setattr__
             try:
                 supset('refreshing', True)
@@ -101,6 +247,7 @@ class MutableModelProxy(object):
                 assert isinstance(proxy, MutableModelProxy)
                 model = proxy.model
                 supset('model', model)
+        model_resolution_cache.set(definition_pk, model)
         return model
 
     def __getattribute__(self, name):
@@ -146,6 +293,7 @@ class ModelDefinition(ContentType):
     verbose_name_plural = LazilyTranslatedField(
         _('verbose name plural'), blank=True, null=True
     )
+    revision = models.PositiveIntegerField(_('revision'), default=0, editable=False)
 
     objects = ModelDefinitionManager()
 
@@ -186,15 +334,53 @@ class ModelDefinition(ContentType):
         # Add those fields to the instance state to be retrieved later
         self._state._create_extra_fields = extra_fields
         self._state._create_delayed_save = delayed_save
-        if self.pk:
+        # Deserialized definitions are initialized without their content type
+        # fields and must not construct a model class without an app label.
+        if self.pk and self.app_label and self.model and not _model_class_construction.deferred:
             self._model_class = self.model_class().model
 
-    def get_model_bases(self):
-        """Build a tuple of bases for the constructed definition"""
+    @classmethod
+    def get_state_prefetch_lookups(cls):
+        """
+        Lookups required to build the state of a definition in a fixed number
+        of queries regardless of its number of fields.
+        """
+        field_def_model = cls._meta.get_field('fielddefinitions').related_model
+        return (
+            Prefetch(
+                'fielddefinitions', queryset=field_def_model.objects.select_subclasses(),
+                to_attr='_prefetched_field_defs'
+            ),
+            '_prefetched_field_defs__choices',
+            Prefetch('uniquetogetherdefinitions', to_attr='_prefetched_unique_together_defs'),
+            '_prefetched_unique_together_defs__field_defs',
+            Prefetch('orderingfielddefinitions', to_attr='_prefetched_ordering_field_defs'),
+            Prefetch('basedefinitions', to_attr='_prefetched_base_defs'),
+        )
+
+    def _get_prefetched_state(self, name, related_name):
+        try:
+            return getattr(self, "_prefetched_%s" % name)
+        except AttributeError:
+            return getattr(self, related_name).all()
+
+    def clear_prefetched_state(self):
+        """Discard the state data fetched by `get_state_prefetch_lookups`."""
+        for name in ('field_defs', 'unique_together_defs', 'ordering_field_defs', 'base_defs'):
+            self.__dict__.pop("_prefetched_%s" % name, None)
+
+    def get_model_bases(self, base_defs=None, model_classes=None):
+        """
+        Build a tuple of bases for the constructed definition. Mutable bases
+        are looked up in `model_classes`, a mapping of definition pks to model
+        classes, before being resolved.
+        """
+        if base_defs is None:
+            base_defs = self._get_prefetched_state('base_defs', 'basedefinitions')
         bases = []
         has_mutable_base = False
-        for base_def in self.basedefinitions.all():
-            base = base_def.construct()
+        for base_def in base_defs:
+            base = base_def.construct(model_classes)
             if issubclass(base, MutableModel):
                 has_mutable_base = True
                 base._dependencies.add((self.__class__, self.pk))
@@ -223,7 +409,9 @@ class ModelDefinition(ContentType):
         # Unique together
         unique_together = [
             ut for ut in (
-                ut_def.construct() for ut_def in self.uniquetogetherdefinitions.all()
+                ut_def.construct() for ut_def in self._get_prefetched_state(
+                    'unique_together_defs', 'uniquetogetherdefinitions'
+                )
             ) if ut
         ]
         if unique_together:
@@ -231,7 +419,9 @@ class ModelDefinition(ContentType):
         # Ordering
         ordering = tuple(
             ord_field_def.construct()
-            for ord_field_def in self.orderingfielddefinitions.all()
+            for ord_field_def in self._get_prefetched_state(
+                'ordering_field_defs', 'orderingfielddefinitions'
+            )
         )
         if ordering:
             # Make sure not to add ordering if it's empty since it would
@@ -252,49 +442,104 @@ class ModelDefinition(ContentType):
             '_definition': (self.__class__, self.pk),
             '_dependencies': set(),
             '_is_obsolete': False,
+            '_checksum_checked_at': None,
+            '_revision': self.revision,
         }
         return attrs
 
-    def get_state(self):
-        fields = [
-            (field_def.name, field_def.construct()) for field_def in self.fielddefinitions.select_subclasses()
-        ]
-        options = self.get_model_opts()
-        bases = self.get_model_bases()
+    def get_state(self, resolve_bases=True):
+        """
+        Build the model state of the definition. When `resolve_bases` is
+        False the bases of the returned state are left unset and must be
+        assigned from `get_model_bases()`.
+        """
+        # Definitions retrieved through `ModelDefinition.objects.prefetch_state()`
+        # already have their state data available.
+        prefetch_related_objects([self], *self.get_state_prefetch_lookups())
+        try:
+            fields = [
+                (field_def.name, field_def.construct()) for field_def in self._prefetched_field_defs
+            ]
+            options = self.get_model_opts()
+            bases = self.get_model_bases() if resolve_bases else ()
+        finally:
+            # Make sure the next state is built from fresh data.
+            self.clear_prefetched_state()
         return ModelState(self.app_label, self.object_name, fields=fields, options=options, bases=bases)
 
-    def construct(self, force_create=False, existing_model_class=None):
-        state = self.get_state()
-        attrs = self.get_model_attrs()
-
-        identifier = (
-            self.pk, self.object_name, state.options, dict(
-                (name, field.deconstruct()) for name, field in state.fields
-            ), [
-                MutableModelProxy(base).checksum()
-                if base is not MutableModel and issubclass(base, MutableModel) else base
-                for base in state.bases
-            ]
+    def bump_revision(self):
+        """
+        Increment the stored revision of the definition in order to mark its
+        existing model classes as outdated.
+        """
+        using = self._state.db or router.db_for_write(self.__class__, instance=self)
+        queryset = self.__class__._default_manager.using(using).filter(pk=self.pk)
+        queryset.update(revision=models.F('revision') + 1)
+        self.revision = queryset.values_list('revision', flat=True).get()
+
+    def refresh_revision(self):
+        queryset = self.__class__._default_manager.db_manager(self._state.db).filter(pk=self.pk)
+        self.revision = queryset.values_list('revision', flat=True).get()
+
+    def get_checksum(self, bases):
+        identifier = "%s:%s:%s" % (self.pk, self.revision, ','.join(
+            MutableModelProxy(base).checksum() for base in bases
+            if base is not MutableModel and issubclass(base, MutableModel)
+        ))
+        return md5(force_bytes(identifier)).hexdigest()
+
+    def is_current(self, model_class):
+        """
+        Return whether or not `model_class` reflects the stored state of the
+        definition without having to build its state.
+        """
+        self.refresh_revision()
+        return model_class._revision == self.revision and not any(
+            base.is_obsolete() for base in model_class.__bases__
+            if base is not MutableModel and issubclass(base, MutableModel)
         )
-        checksum = md5(pickle.dumps(identifier)).hexdigest()
-        state_handler.set_checksum(self.pk, checksum)
 
+    def construct(self, force_create=False, existing_model_class=None, state=None):
         if existing_model_class:
-            if not force_create and existing_model_class._checksum == checksum:
+            if not force_create and self.is_current(existing_model_class):
                 existing_model_class._is_obsolete = False
+                with metrics.timer('state_handler.set'):
+                    state_handler.set_checksum(self.pk, existing_model_class._checksum)
+                mutable_model_registry.register(existing_model_class)
                 return existing_model_class
+
+        if state is None:
+            state = self.get_state()
+        attrs = self.get_model_attrs()
+
+        with metrics.timer('checksum.compute', definition=self.pk):
+            checksum = self.get_checksum(state.bases)
+        with metrics.timer('state_handler.set'):
+            state_handler.set_checksum(self.pk, checksum)
+        model_resolution_cache.invalidate(self.pk)
+
+        if existing_model_class:
             remove_from_app_cache(existing_model_class)
             existing_model_class.mark_as_obsolete()
+        # Versions evicted from the registry might still be in use by their
+        # instances and must not be trusted once the state changed.
+        for version in mutable_model_registry.get_versions((self.__class__, self.pk)):
+            if version._checksum != checksum and not version._is_obsolete:
+                version.mark_as_obsolete()
 
         try:
-            model_class = state.render(apps)
+            with metrics.timer('model_state.render', model="%s.%s" % (state.app_label, state.name)), \
+                    targeted_cache_expiry():
+                model_class = state.render(apps)
         except RuntimeError:
             # Account for race conditions between the removal from the apps
             # and the rendering of the new state.
             return apps.get_model(state.app_label, state.name)
+        expire_related_caches(model_class)
         model_class._checksum = checksum
         for attr, value in attrs.items():
             setattr(model_class, attr, value)
+        mutable_model_registry.register(model_class)
 
         mutable_class_prepared.send(
             sender=model_class, definition=self,
@@ -304,12 +549,50 @@ class ModelDefinition(ContentType):
 
         return model_class
 
+    def _get_model_class(self):
+        # The registry is consulted first since its lookups don't involve
+        # the app registry which is mutated while model classes are rebuilt.
+        model_class = mutable_model_registry.get((self.__class__, self.pk))
+        # Definitions loaded from fixtures might have been registered before
+        # their content type fields were assigned.
+        if model_class is None or (model_class._meta.app_label, model_class._meta.model_name) != (
+                self.app_label, self.model):
+            model_class = super(ModelDefinition, self).model_class()
+        return model_class
+
+    def _construct_model_class(self, force_create):
+        model_class = self._get_model_class()
+        # Another thread might have constructed the model class while this
+        # one was waiting.
+        if force_create or model_class is None or model_class.is_obsolete():
+            with metrics.timer('model_class.construct', definition=self.pk):
+                model_class = self.construct(force_create, model_class)
+        return model_class
+
     def model_class(self, force_create=False):
-        model_class = super(ModelDefinition, self).model_class()
+        model_class = self._get_model_class()
         if force_create or model_class is None or model_class.is_obsolete():
-            model_class = self.construct(force_create, model_class)
+            # Concurrent constructions of the same model class are performed
+            # only once; forced ones must begin after the call is made.
+            model_class = model_class_constructions.run(
+                self.pk, partial(self._construct_model_class, force_create),
+                join=not force_create, timeout=settings.CONSTRUCTION_TIMEOUT,
+            )
+            size = settings.MODEL_CLASS_CACHE_SIZE
+            if size is not None and len(mutable_model_registry) > size:
+                evict_model_classes(size)
         return MutableModelProxy(model_class)
 
+    def rebuild_model_class(self, force_create=True):
+        """
+        Rebuild the model class after an alteration or defer it until the
+        end of the current `bulk_alter()` block.
+        """
+        if schema_alteration.active:
+            schema_alteration.defer_rebuild(self)
+        else:
+            self.model_class(force_create=force_create)
+
     @property
     def model_ct(self):
         try:
@@ -326,7 +609,11 @@ class ModelDefinition(ContentType):
         model_class = getattr(self, '_model_class', None)
         if model_class:
             remove_from_app_cache(model_class)
-        return super(ModelDefinition, self).save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            if not self._state.adding:
+                self.bump_revision()
+            return super(ModelDefinition, self).save(*args, **kwargs)
 
 
 class ModelDefinitionAttribute(models.Model):
@@ -344,14 +631,20 @@ class ModelDefinitionAttribute(models.Model):
 
     def save(self, *args, **kwargs):
         force_create = kwargs.pop('force_create_model_class', True)
-        save = super(ModelDefinitionAttribute, self).save(*args, **kwargs)
-        self.model_def.model_class(force_create=force_create)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            save = super(ModelDefinitionAttribute, self).save(*args, **kwargs)
+            self.model_def.bump_revision()
+        self.model_def.rebuild_model_class(force_create)
         return save
 
     def delete(self, *args, **kwargs):
         force_create = kwargs.pop('force_create_model_class', True)
-        delete = super(ModelDefinitionAttribute, self).delete(*args, **kwargs)
-        self.model_def.model_class(force_create=force_create)
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using):
+            delete = super(ModelDefinitionAttribute, self).delete(*args, **kwargs)
+            self.model_def.bump_revision()
+        self.model_def.rebuild_model_class(force_create)
         return delete
 
 
@@ -387,10 +680,26 @@ class BaseDefinition(OrderedModelDefinitionAttribute):
             raise ValidationError(_('Base must be a class.'))
         return super(BaseDefinition, self).clean()
 
-    def construct(self):
-        if isinstance(self.base, MutableModelProxy):
-            return self.base.__get__()
-        return self.base
+    @property
+    def base_definition_pk(self):
+        """Primary key of the definition of the base if it's mutable."""
+        base = self.base
+        if isinstance(base, DeferredModelClass):
+            return base.definition_pk
+        elif isinstance(base, MutableModelProxy):
+            return base.model._definition[1]
+
+    def construct(self, model_classes=None):
+        base = self.base
+        if model_classes:
+            model_class = model_classes.get(self.base_definition_pk)
+            if model_class is not None:
+                return model_class
+        if isinstance(base, DeferredModelClass):
+            base = base.resolve()
+        if isinstance(base, MutableModelProxy):
+            return base.__get__()
+        return base
 
     def get_declared_fields(self, field_defs=None):
         if field_defs is None:
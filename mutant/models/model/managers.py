@@ -1,8 +1,49 @@
 from __future__ import unicode_literals
 
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import django
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
+from ...management import bulk_alter
+
+
+@contextmanager
+def timed(timings, phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[phase] = time.time() - start
+
+
+def sort_by_bases(definitions):
+    """
+    Sort prefetched definitions so that the ones used as mutable bases come
+    before the definitions inheriting from them without resolving the model
+    classes of the bases.
+    """
+    definitions_by_pk = dict((definition.pk, definition) for definition in definitions)
+    sorted_definitions = []
+    visited = set()
+
+    def visit(definition):
+        if definition.pk in visited:
+            return
+        visited.add(definition.pk)
+        for base_def in definition._prefetched_base_defs:
+            base_definition = definitions_by_pk.get(base_def.base_definition_pk)
+            if base_definition is not None:
+                visit(base_definition)
+        sorted_definitions.append(definition)
+
+    for definition in definitions:
+        visit(definition)
+    return sorted_definitions
+
 
 class ModelDefinitionQuerySet(models.QuerySet):
     def _extract_model_params(self, defaults, **kwargs):
@@ -20,6 +61,61 @@ class ModelDefinitionQuerySet(models.QuerySet):
     def get_by_natural_key(self, app_label, model):
         return self.get(app_label=app_label, model=model)
 
+    def prefetch_state(self):
+        """
+        Fetch everything required to build the model state of the retrieved
+        definitions in a fixed number of queries.
+        """
+        return self.prefetch_related(*self.model.get_state_prefetch_lookups())
+
+    def bulk_alter(self):
+        """
+        Return a context manager deferring the schema alterations and model
+        class rebuilds triggered by definition changes until it exits.
+
+        Queued DDL operations are executed in a single schema editor session
+        per database and each altered definition is rebuilt once.
+        """
+        return bulk_alter(self.db)
+
+    def warm_up(self):
+        """
+        Construct the model classes of the retrieved definitions in bulk.
+
+        Definitions are loaded along with their state in a fixed number of
+        queries without resolving their mutable bases. The states of the
+        missing or obsolete model classes are collected first and rendered
+        once in dependency order, the ones of the bases being reused for the
+        definitions inheriting from them, while their checksums are published
+        to the state handler.
+        Returns an ordered mapping of phase names to their duration in seconds.
+        """
+        from . import defer_model_class_construction
+
+        timings = OrderedDict()
+        with timed(timings, 'load'), defer_model_class_construction():
+            definitions = list(self.prefetch_state())
+        with timed(timings, 'sort'):
+            definitions = sort_by_bases(definitions)
+        with timed(timings, 'state'):
+            states = []
+            for definition in definitions:
+                model_class = ContentType.model_class(definition)
+                if model_class is None or model_class.is_obsolete():
+                    base_defs = definition._prefetched_base_defs
+                    states.append((definition, model_class, base_defs, definition.get_state(resolve_bases=False)))
+                else:
+                    definition.clear_prefetched_state()
+                    definition._model_class = model_class
+        with timed(timings, 'render'):
+            model_classes = {}
+            for definition, model_class, base_defs, state in states:
+                state.bases = definition.get_model_bases(base_defs, model_classes)
+                definition._model_class = model_classes[definition.pk] = definition.construct(
+                    existing_model_class=model_class, state=state
+                )
+        return timings
+
 
 class ModelDefinitionManager(models.Manager.from_queryset(ModelDefinitionQuerySet)):
     if django.VERSION < (1, 10):
@@ -0,0 +1,58 @@
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+
+class ChecksumChangeManager(models.Manager):
+    def record(self, definition_pk, checksum, tombstone_ttl=None, revision=None, node=None):
+        """
+        Record a checksum change and compact the previous changes of the
+        definition. Superseded changes are kept as tombstones for
+        `tombstone_ttl` seconds if specified.
+        """
+        change = self.create(definition_pk=definition_pk, checksum=checksum, revision=revision, node=node)
+        superseded = self.filter(definition_pk=definition_pk, pk__lt=change.pk, compacted_at=None)
+        if tombstone_ttl is None:
+            superseded.delete()
+        else:
+            now = timezone.now()
+            superseded.update(checksum=None, compacted_at=now)
+            self.filter(compacted_at__lt=now - timedelta(seconds=tombstone_ttl)).delete()
+        return change
+
+    def snapshot(self):
+        """
+        Return a mapping of definition pks to the `(checksum, revision, node)`
+        tuple of their latest change.
+        """
+        changes = self.filter(compacted_at=None).order_by('pk').values_list(
+            'definition_pk', 'checksum', 'revision', 'node'
+        )
+        return dict((change[0], change[1:]) for change in changes)
+
+
+class ChecksumChange(models.Model):
+    """
+    Append-only log of model definition checksum changes used by the database
+    state handler. The primary key of a row is used as a global revision.
+
+    Changes superseded by a later change of the same definition are kept as
+    tombstones, flagged by `compacted_at`, until they are purged. The logical
+    `revision` and `node` are only recorded by the PostgreSQL pub/sub engine.
+    """
+    definition_pk = models.PositiveIntegerField(_('definition pk'), db_index=True)
+    checksum = models.CharField(_('checksum'), max_length=32, null=True)
+    compacted_at = models.DateTimeField(_('compacted at'), null=True, db_index=True)
+    revision = models.BigIntegerField(_('revision'), null=True)
+    node = models.CharField(_('node'), max_length=32, null=True)
+
+    objects = ChecksumChangeManager()
+
+    class Meta:
+        app_label = 'mutant'
+        verbose_name = _('checksum change')
+        verbose_name_plural = _('checksum changes')
@@ -17,3 +17,39 @@ STATE_PUBSUB = getattr(
         'mutant.state.handlers.pubsub.engines.Redis', {}
     )
 )
+
+STATE_PUBSUB_BATCH = getattr(
+    settings, 'MUTANT_STATE_PUBSUB_BATCH', None
+)
+
+STATE_STALENESS_WINDOW = getattr(
+    settings, 'MUTANT_STATE_STALENESS_WINDOW', 0
+)
+
+METRICS = getattr(
+    settings, 'MUTANT_METRICS', 'mutant.metrics.NullMetrics'
+)
+
+CONSTRUCTION_TIMEOUT = getattr(
+    settings, 'MUTANT_CONSTRUCTION_TIMEOUT', 30
+)
+
+STATE_LOCAL_TTL = getattr(
+    settings, 'MUTANT_STATE_LOCAL_TTL', 1
+)
+
+STATE_POLL_INTERVAL = getattr(
+    settings, 'MUTANT_STATE_POLL_INTERVAL', 1
+)
+
+REBIND_OBSOLETE_INSTANCES = getattr(
+    settings, 'MUTANT_REBIND_OBSOLETE_INSTANCES', False
+)
+
+MODEL_CLASS_CACHE_SIZE = getattr(
+    settings, 'MUTANT_MODEL_CLASS_CACHE_SIZE', None
+)
+
+RENDERED_STATES_CACHE_SIZE = getattr(
+    settings, 'MUTANT_RENDERED_STATES_CACHE_SIZE', 128
+)
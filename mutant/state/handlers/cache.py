@@ -21,10 +21,24 @@ class CacheStateHandler(object):
         cache_key = self.get_cache_key(definition_pk)
         return self.cache.get(cache_key)
 
+    def get_many_checksums(self, definition_pks):
+        cache_keys = dict(
+            (self.get_cache_key(definition_pk), definition_pk) for definition_pk in definition_pks
+        )
+        checksums = self.cache.get_many(cache_keys)
+        return dict(
+            (definition_pk, checksums.get(cache_key)) for cache_key, definition_pk in cache_keys.items()
+        )
+
     def set_checksum(self, definition_pk, checksum):
         cache_key = self.get_cache_key(definition_pk)
         return self.cache.set(cache_key, checksum)
 
+    def set_many_checksums(self, checksums):
+        return self.cache.set_many(dict(
+            (self.get_cache_key(definition_pk), checksum) for definition_pk, checksum in checksums.items()
+        ))
+
     def clear_checksum(self, definition_pk):
         cache_key = self.get_cache_key(definition_pk)
         return self.cache.delete(cache_key)
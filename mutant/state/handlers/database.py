@@ -0,0 +1,157 @@
+from __future__ import unicode_literals
+
+import time
+from functools import partial
+from threading import local
+
+from django.db import router, transaction
+from django.db.models import Max, Q
+
+from ... import settings
+from ...compat import on_commit
+from ...models.state import ChecksumChange
+from .memory import MemoryStateHandler
+
+
+class DatabaseStateHandler(MemoryStateHandler):
+    """
+    State handler that relies on an append-only table of checksum changes to
+    share the current state of mutable models between processes.
+
+    Every `interval` seconds the maximum revision is retrieved and, only if it
+    changed, the checksums changed since the last seen revision are fetched.
+
+    Since revisions are allocated before the transaction they belong to is
+    committed, revisions skipped while polling are fetched again until they
+    show up or `gap_timeout` seconds have elapsed. Superseded changes are
+    kept as tombstones for as long so they are not mistaken for skipped ones.
+
+    Local changes are only applied once the transaction they belong to is
+    committed; until then they are only visible to the thread performing it.
+    """
+
+    def __init__(self, interval=None, gap_timeout=60):
+        super(DatabaseStateHandler, self).__init__()
+        self.interval = settings.STATE_POLL_INTERVAL if interval is None else interval
+        self.gap_timeout = gap_timeout
+        self.local = local()
+        self.reset()
+
+    def reset(self):
+        self.revision = None
+        self.revisions = {}
+        self.gaps = {}
+        self.polled_at = None
+
+    def flush(self):
+        with self.lock:
+            super(DatabaseStateHandler, self).flush()
+            self.reset()
+
+    def apply(self, revision, definition_pk, checksum):
+        if revision > self.revisions.get(definition_pk, 0):
+            self.revisions[definition_pk] = revision
+            self.checksums[definition_pk] = checksum
+
+    def get_pending_changes(self):
+        """
+        Return the `(revision, definition_pk, checksum)` changes recorded by
+        the transaction of the current thread that are yet to be committed.
+        """
+        changes = getattr(self.local, 'changes', None)
+        if not changes:
+            return []
+        connection = transaction.get_connection(router.db_for_write(ChecksumChange))
+        # Callbacks of rolled back transactions and savepoints are discarded
+        # and the ones of committed transactions are run and cleared.
+        callbacks = set(func for _sids, func in getattr(connection, 'run_on_commit', []))
+        self.local.changes = [change for change in changes if change[0] in callbacks]
+        return [change[1:] for change in self.local.changes]
+
+    def fetch(self, last_revision, gaps):
+        revision = ChecksumChange.objects.aggregate(revision=Max('pk'))['revision'] or 0
+        if revision <= last_revision and not gaps:
+            return last_revision, []
+        lookup = Q(pk__gt=last_revision)
+        if gaps:
+            lookup |= Q(pk__in=gaps)
+        changes = ChecksumChange.objects.filter(lookup).values_list(
+            'pk', 'definition_pk', 'checksum', 'compacted_at'
+        )
+        return revision, list(changes)
+
+    def poll(self, force=False):
+        connection = transaction.get_connection(router.db_for_read(ChecksumChange))
+        # No queries can be performed until a broken transaction is rolled
+        # back; the last retrieved state is served in the meantime.
+        if connection.in_atomic_block and connection.needs_rollback:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and self.polled_at is not None and 0 <= now - self.polled_at < self.interval:
+                return
+            self.polled_at = now
+            for gap, detected_at in list(self.gaps.items()):
+                if now - detected_at >= self.gap_timeout:
+                    del self.gaps[gap]
+            previous_revision = self.revision
+            gaps = list(self.gaps)
+        # Changes are fetched without holding the lock to avoid holding up
+        # threads that only read the current state.
+        last_revision = previous_revision or 0
+        revision, changes = self.fetch(last_revision, gaps)
+        # Uncommitted changes of the current thread are applied on commit.
+        pending = set(change[0] for change in self.get_pending_changes())
+        with self.lock:
+            seen = set()
+            for pk, definition_pk, checksum, compacted_at in changes:
+                if compacted_at is None and pk not in pending:
+                    self.apply(pk, definition_pk, checksum)
+                seen.add(pk)
+            if self.revision != previous_revision:
+                # Another thread completed a poll in the meantime.
+                return
+            revision = max([revision] + list(seen))
+            # Earlier changes are compacted away hence there is no way to
+            # distinguish them from gaps when polling for the first time.
+            if previous_revision is not None:
+                for gap in range(last_revision + 1, revision):
+                    if gap not in seen:
+                        self.gaps[gap] = now
+            for gap in seen:
+                self.gaps.pop(gap, None)
+            self.revision = revision
+
+    def get_checksum(self, definition_pk):
+        return self.get_many_checksums([definition_pk])[definition_pk]
+
+    def get_many_checksums(self, definition_pks):
+        self.poll()
+        checksums = super(DatabaseStateHandler, self).get_many_checksums(definition_pks)
+        for _revision, definition_pk, checksum in self.get_pending_changes():
+            if definition_pk in checksums:
+                checksums[definition_pk] = checksum
+        return checksums
+
+    def commit(self, revision, definition_pk, checksum):
+        with self.lock:
+            self.apply(revision, definition_pk, checksum)
+
+    def set_checksum(self, definition_pk, checksum):
+        # Only the latest change of a definition is relevant to processes
+        # that are yet to retrieve it.
+        change = ChecksumChange.objects.record(definition_pk, checksum, self.gap_timeout)
+        using = router.db_for_write(ChecksumChange)
+        callback = partial(self.commit, change.pk, definition_pk, checksum)
+        if transaction.get_connection(using).in_atomic_block:
+            changes = getattr(self.local, 'changes', [])
+            changes.append((callback, change.pk, definition_pk, checksum))
+            self.local.changes = changes
+        on_commit(callback, using=using)
+
+    def set_many_checksums(self, checksums):
+        for definition_pk, checksum in checksums.items():
+            self.set_checksum(definition_pk, checksum)
+
+    def clear_checksum(self, definition_pk):
+        self.set_checksum(definition_pk, None)
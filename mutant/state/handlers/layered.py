@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+
+import time
+import uuid
+from threading import RLock
+
+from ... import settings
+from .cache import CacheStateHandler
+
+
+class LayeredStateHandler(CacheStateHandler):
+    """
+    State handler that serves checksums from an in-memory map and relies on
+    cache to share them between processes.
+
+    Every write to the shared cache bumps a version token associated with the
+    definition. Once `ttl` seconds have elapsed since the last validation the
+    tokens of the locally known definitions are fetched again and the entries
+    whose token changed are discarded, which guarantees changes performed by
+    other processes are picked up within `ttl` seconds.
+    """
+
+    def __init__(self, ttl=None):
+        super(LayeredStateHandler, self).__init__()
+        self.ttl = settings.STATE_LOCAL_TTL if ttl is None else ttl
+        self.lock = RLock()
+        self.checksums = {}
+        self.versions = {}
+        self.validated_at = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def flush(self):
+        with self.lock:
+            self.checksums.clear()
+            self.versions.clear()
+            self.validated_at = None
+
+    def get_version_key(self, definition_pk):
+        return "mutant-version-%s" % definition_pk
+
+    def get_many_versions(self, definition_pks):
+        version_keys = dict(
+            (self.get_version_key(definition_pk), definition_pk) for definition_pk in definition_pks
+        )
+        versions = self.cache.get_many(version_keys)
+        return dict(
+            (definition_pk, versions.get(version_key)) for version_key, definition_pk in version_keys.items()
+        )
+
+    def revalidate(self):
+        now = time.time()
+        with self.lock:
+            if self.validated_at is not None and 0 <= now - self.validated_at < self.ttl:
+                return
+            if self.checksums:
+                versions = self.get_many_versions(list(self.checksums))
+                for definition_pk, version in versions.items():
+                    if version != self.versions.get(definition_pk):
+                        self.stale += 1
+                        del self.checksums[definition_pk]
+                        self.versions[definition_pk] = version
+            self.validated_at = now
+
+    def bump_versions(self, definition_pks):
+        versions = dict((definition_pk, uuid.uuid4().hex) for definition_pk in definition_pks)
+        self.cache.set_many(dict(
+            (self.get_version_key(definition_pk), version) for definition_pk, version in versions.items()
+        ), None)
+        return versions
+
+    def store(self, checksums, versions, expected_versions):
+        # Entries invalidated or written locally while they were fetched are
+        # left alone as the fetched checksums might be stale.
+        with self.lock:
+            for definition_pk, checksum in checksums.items():
+                if self.versions.get(definition_pk) == expected_versions.get(definition_pk):
+                    self.checksums[definition_pk] = checksum
+                    self.versions[definition_pk] = versions[definition_pk]
+
+    def get_checksum(self, definition_pk):
+        return self.get_many_checksums([definition_pk])[definition_pk]
+
+    def get_many_checksums(self, definition_pks):
+        self.revalidate()
+        checksums = {}
+        missing = []
+        with self.lock:
+            for definition_pk in definition_pks:
+                try:
+                    checksums[definition_pk] = self.checksums[definition_pk]
+                except KeyError:
+                    missing.append(definition_pk)
+            self.hits += len(checksums)
+            self.misses += len(missing)
+            expected_versions = dict((definition_pk, self.versions.get(definition_pk)) for definition_pk in missing)
+        if missing:
+            # Versions must be retrieved before checksums as writers bump
+            # them after storing the checksums.
+            versions = self.get_many_versions(missing)
+            fetched = super(LayeredStateHandler, self).get_many_checksums(missing)
+            self.store(fetched, versions, expected_versions)
+            checksums.update(fetched)
+        return checksums
+
+    def set_checksum(self, definition_pk, checksum):
+        self.set_many_checksums({definition_pk: checksum})
+
+    def set_many_checksums(self, checksums):
+        super(LayeredStateHandler, self).set_many_checksums(checksums)
+        versions = self.bump_versions(checksums)
+        with self.lock:
+            self.checksums.update(checksums)
+            self.versions.update(versions)
+
+    def clear_checksum(self, definition_pk):
+        super(LayeredStateHandler, self).clear_checksum(definition_pk)
+        versions = self.bump_versions([definition_pk])
+        with self.lock:
+            self.checksums[definition_pk] = None
+            self.versions.update(versions)
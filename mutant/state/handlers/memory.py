@@ -21,10 +21,19 @@ class MemoryStateHandler(object):
     def get_checksum(self, definition_pk):
         return self.checksums.get(definition_pk)
 
+    def get_many_checksums(self, definition_pks):
+        return dict(
+            (definition_pk, self.checksums.get(definition_pk)) for definition_pk in definition_pks
+        )
+
     def set_checksum(self, definition_pk, checksum):
         with self.lock:
             self.checksums[definition_pk] = checksum
 
+    def set_many_checksums(self, checksums):
+        with self.lock:
+            self.checksums.update(checksums)
+
     def clear_checksum(self, definition_pk):
         with self.lock:
             try:
@@ -1,44 +1,194 @@
 from __future__ import unicode_literals
 
+import logging
 import time
+import uuid
+from collections import OrderedDict
+from threading import Thread
 
 from django.utils.module_loading import import_string
+from django.utils.six.moves.queue import Empty, Queue
 
 from mutant import settings
 
 from ..memory import MemoryStateHandler
 
+logger = logging.getLogger(__name__)
+
+
+class BatchPublisher(Thread):
+    """
+    Publish messages through an engine from a background thread in batches
+    of at most `size` messages collected for at most `interval` seconds.
+    """
+
+    STOP = object()
+
+    def __init__(self, engine, interval=0.05, size=100):
+        super(BatchPublisher, self).__init__(name="%s.%s" % (self.__module__, self.__class__.__name__))
+        self.daemon = True
+        self.engine = engine
+        self.interval = interval
+        self.size = size
+        self.queue = Queue()
+
+    def publish(self, *args):
+        self.queue.put(args)
+
+    def publish_many(self, messages):
+        for args in messages:
+            self.queue.put(args)
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.interval
+        while batch[-1] is not self.STOP and len(batch) < self.size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is self.STOP
+            messages = batch[:-1] if stop else batch
+            try:
+                if messages:
+                    self.engine.publish_many(messages)
+            except Exception:
+                logger.exception('Failed to publish %d messages.', len(messages))
+            finally:
+                for _message in batch:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """Block until all the queued messages are published."""
+        self.queue.join()
+
+    def stop(self, timeout=None):
+        self.queue.put(self.STOP)
+        self.join(timeout)
+
 
 class PubSubStateHandler(MemoryStateHandler):
-    def __init__(self, engine=None):
+    """
+    State handler that relies on an engine to publish checksum changes to
+    the other processes.
+
+    Changes of a definition are ordered by their logical revision, ties
+    being broken by node identifier. Revisions are allocated from a Lamport
+    clock shared by all the definitions of the node which is advanced by
+    every received change and seeded from the revisions of the engine
+    snapshot and the current time in milliseconds. Forgetting the revision
+    of a definition, on restart or once more than `max_revisions` are
+    remembered, can thus never lead to the allocation of a revision lower
+    than the ones known by other nodes. Changes of definitions whose
+    revision was forgotten are always applied.
+    """
+
+    def __init__(self, engine=None, batch=None, max_revisions=10000):
         super(PubSubStateHandler, self).__init__()
         dotted_path, options = engine or settings.STATE_PUBSUB
         engine_cls = import_string(dotted_path)
-        self.timestamps = {}
-        self.engine = engine_cls(self.flush, self.receive, **options)
+        self.node = uuid.uuid4().hex
+        self.clock = int(time.time() * 1000)
+        self.revisions = OrderedDict()
+        self.max_revisions = max_revisions
+        self.engine = engine_cls(self.resync, self.receive, **options)
         self.engine.start()
         while not self.engine.ready:
             time.sleep(0.1)
-
-    def receive(self, definition_pk, checksum, timestamp):
-        # Do not alter current state if the change was published before our
-        if self.timestamps.get(definition_pk, timestamp) > timestamp:
-            return
-        if checksum is None:
-            super(PubSubStateHandler, self).clear_checksum(definition_pk)
+        batch = batch or settings.STATE_PUBSUB_BATCH
+        if batch:
+            self.publisher = BatchPublisher(self.engine, **batch)
+            self.publisher.start()
         else:
-            super(PubSubStateHandler, self).set_checksum(definition_pk, checksum)
+            self.publisher = self.engine
+
+    def resync(self):
+        """
+        Synchronize the checksums with the snapshot of the engine when it
+        (re)connects and return the pks of the definitions that changed.
+        Fallback to flushing all of them if no snapshot is available.
+        """
+        snapshot = self.engine.snapshot()
+        if snapshot is None:
+            self.flush()
+            return None
+        with self.lock:
+            checksums = {}
+            for definition_pk, (checksum, revision, node) in snapshot.items():
+                if checksum is not None:
+                    checksums[definition_pk] = checksum
+                if revision is not None:
+                    self.clock = max(self.clock, revision)
+                    version = (revision, node)
+                    if version > self.revisions.get(definition_pk, (0, '')):
+                        self.remember(definition_pk, version)
+            changed = [
+                definition_pk for definition_pk in set(self.checksums).union(checksums)
+                if self.checksums.get(definition_pk) != checksums.get(definition_pk)
+            ]
+            for definition_pk in changed:
+                checksum = checksums.get(definition_pk)
+                if checksum is None:
+                    super(PubSubStateHandler, self).clear_checksum(definition_pk)
+                else:
+                    super(PubSubStateHandler, self).set_checksum(definition_pk, checksum)
+        if changed:
+            logger.debug('Resynchronized %d checksums.', len(changed))
+        return changed
+
+    def remember(self, definition_pk, version):
+        self.revisions.pop(definition_pk, None)
+        self.revisions[definition_pk] = version
+        while len(self.revisions) > self.max_revisions:
+            self.revisions.popitem(last=False)
+
+    def next_revision(self, definition_pk):
+        self.clock += 1
+        self.remember(definition_pk, (self.clock, self.node))
+        return self.clock
+
+    def receive(self, definition_pk, checksum, revision, node):
+        version = (revision, node)
+        with self.lock:
+            self.clock = max(self.clock, revision)
+            # Ignore duplicate deliveries and changes superseded by one that
+            # was already received or performed locally.
+            current = self.revisions.get(definition_pk)
+            if current is not None and current >= version:
+                return
+            self.remember(definition_pk, version)
+            if checksum is None:
+                super(PubSubStateHandler, self).clear_checksum(definition_pk)
+            else:
+                super(PubSubStateHandler, self).set_checksum(definition_pk, checksum)
 
     def set_checksum(self, definition_pk, checksum):
-        timestamp = time.time()
         with self.lock:
-            self.timestamps[definition_pk] = timestamp
+            revision = self.next_revision(definition_pk)
             super(PubSubStateHandler, self).set_checksum(definition_pk, checksum)
-        self.engine.publish(definition_pk, checksum, timestamp)
+        self.publisher.publish(definition_pk, checksum, revision, self.node)
+
+    def set_many_checksums(self, checksums):
+        with self.lock:
+            messages = [
+                (definition_pk, checksum, self.next_revision(definition_pk), self.node)
+                for definition_pk, checksum in checksums.items()
+            ]
+            super(PubSubStateHandler, self).set_many_checksums(checksums)
+        self.publisher.publish_many(messages)
 
     def clear_checksum(self, definition_pk):
-        timestamp = time.time()
         with self.lock:
-            self.timestamps[definition_pk] = timestamp
+            revision = self.next_revision(definition_pk)
             super(PubSubStateHandler, self).clear_checksum(definition_pk)
-        self.engine.publish(definition_pk, None, timestamp)
+        self.publisher.publish(definition_pk, None, revision, self.node)
@@ -1,17 +1,48 @@
 from __future__ import unicode_literals
 
+import errno
 import json
 import logging
 import math
+import os
+import select
+import socket
+import stat
+import tempfile
 import time
+import uuid
 from threading import Thread
 
 import redis
-from django.utils.encoding import force_str
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils.encoding import force_bytes, force_str
+
+from ....models.state import ChecksumChange
 
 logger = logging.getLogger(__name__)
 
 
+def split_payloads(messages, max_size):
+    """
+    Split messages into JSON encoded arrays of at most `max_size` bytes.
+    Messages that are larger on their own are yielded alone.
+    """
+    encoded = []
+    size = 2
+    for args in messages:
+        message = force_bytes(json.dumps(list(args)))
+        # Account for the separator and the enclosing brackets.
+        if encoded and size + len(message) + 2 > max_size:
+            yield b'[' + b', '.join(encoded) + b']'
+            encoded = []
+            size = 2
+        size += len(message) + (2 if encoded else 0)
+        encoded.append(message)
+    if encoded:
+        yield b'[' + b', '.join(encoded) + b']'
+
+
 class BaseEngine(Thread):
     def __init__(self, initialize, callback):
         self.initialize = initialize
@@ -29,11 +60,24 @@ class BaseEngine(Thread):
     def publish(self, *args):
         raise NotImplementedError
 
+    def publish_many(self, messages):
+        for args in messages:
+            self.publish(*args)
+
+    def snapshot(self):
+        """
+        Return a mapping of definition pks to the `(checksum, revision, node)`
+        tuple of their last published change or `None` if the engine doesn't
+        keep track of them.
+        """
+        return None
+
 
 class Redis(BaseEngine):
-    def __init__(self, initialize, callback, channel='mutant-state',
+    def __init__(self, initialize, callback, channel='mutant-state', snapshot_key=None,
                  socket_timeout=60*10, socket_keepalive=True, **options):
         super(Redis, self).__init__(initialize, callback)
+        self.snapshot_key = snapshot_key or "%s-snapshot" % channel
         self.redis = redis.StrictRedis(
             socket_timeout=socket_timeout,
             socket_keepalive=socket_keepalive,
@@ -49,8 +93,13 @@ class Redis(BaseEngine):
         self._initialize()
         for event in self.pubsub.listen():
             if event['type'] == 'message':
-                args = json.loads(force_str(event['data']))
-                self.callback(*args)
+                payload = json.loads(force_str(event['data']))
+                # Batches are published as arrays of arguments.
+                if payload and isinstance(payload[0], list):
+                    for args in payload:
+                        self.callback(*args)
+                else:
+                    self.callback(*payload)
 
     def _reconnect(self):
         connection = self.pubsub.connection
@@ -81,10 +130,225 @@ class Redis(BaseEngine):
             self._reconnect()
             self.run()
 
+    def _publish(self, messages, message):
+        # Keep the snapshot and the published messages consistent. Cleared
+        # checksums are kept around as their revision must not be forgotten.
+        pipeline = self.redis.pipeline()
+        for args in messages:
+            pipeline.hset(self.snapshot_key, args[0], json.dumps(list(args[1:])))
+        pipeline.publish(self.channel, message)
+        pipeline.execute()
+
     def publish(self, *args):
-        message = json.dumps(args)
-        self.redis.publish(self.channel, message)
+        self._publish([args], json.dumps(args))
+
+    def publish_many(self, messages):
+        messages = [list(args) for args in messages]
+        self._publish(messages, json.dumps(messages))
+
+    def snapshot(self):
+        return dict(
+            (int(definition_pk), tuple(json.loads(force_str(change))))
+            for definition_pk, change in self.redis.hgetall(self.snapshot_key).items()
+        )
 
     def join(self, timeout=None):
         self.pubsub.unsubscribe(self.channel)
         super(Redis, self).join(timeout=None)
+
+
+class Postgres(BaseEngine):
+    """
+    Engine relying on PostgreSQL LISTEN/NOTIFY.
+
+    Notifications are emitted on the connection of the `using` database
+    hence they are only delivered once the transaction in which the
+    checksum was changed is committed. This guarantee doesn't hold when
+    publishing in batches from a background thread.
+
+    Published checksums are recorded in the checksum changes table within
+    the same transaction in order to provide snapshots. The listening
+    connection is re-established with an exponential backoff of at most
+    `max_reconnect_delay` seconds on failure.
+    """
+
+    # NOTIFY payloads must be shorter than 8000 bytes.
+    max_payload_size = 7999
+
+    def __init__(self, initialize, callback, channel='mutant_state', using=DEFAULT_DB_ALIAS,
+                 poll_interval=5, reconnect_delay=1, max_reconnect_delay=60):
+        super(Postgres, self).__init__(initialize, callback)
+        self.channel = channel
+        self.using = using
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.listening = True
+        self.Error = connections[using].Database.Error
+        self._connect()
+
+    def _connect(self):
+        wrapper = connections[self.using]
+        self.connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute('LISTEN %s' % wrapper.ops.quote_name(self.channel))
+
+    def _run(self):
+        self._initialize()
+        while self.listening:
+            if not select.select([self.connection], [], [], self.poll_interval)[0]:
+                continue
+            self.connection.poll()
+            while self.connection.notifies:
+                notify = self.connection.notifies.pop(0)
+                for args in json.loads(notify.payload):
+                    self.callback(*args)
+
+    def _close(self):
+        try:
+            self.connection.close()
+        except self.Error:
+            pass
+
+    def _reconnect(self):
+        self._close()
+        delay = self.reconnect_delay
+        while self.listening:
+            logger.info('Attempting to reconnect.')
+            try:
+                self._connect()
+            except self.Error:
+                logger.exception('Failed to reconnect, will re-attempt in %s seconds.', delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+            else:
+                logger.info('Successfully reconnected.')
+                return True
+        return False
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    # Notifications emitted while disconnected are lost hence
+                    # the state is resynchronized from a snapshot on connection.
+                    self._run()
+                except (self.Error, select.error, ValueError):
+                    if not self.listening:
+                        return
+                    logger.warning('Connection error.')
+                    if not self._reconnect():
+                        return
+                else:
+                    return
+        finally:
+            self._close()
+
+    def publish(self, *args):
+        self.publish_many([args])
+
+    def publish_many(self, messages):
+        with transaction.atomic(using=self.using):
+            changes = ChecksumChange.objects.db_manager(self.using)
+            for definition_pk, checksum, revision, node in messages:
+                changes.record(definition_pk, checksum, revision=revision, node=node)
+            with connections[self.using].cursor() as cursor:
+                for payload in split_payloads(messages, self.max_payload_size):
+                    cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, force_str(payload)])
+
+    def snapshot(self):
+        return ChecksumChange.objects.db_manager(self.using).snapshot()
+
+    def join(self, timeout=None):
+        self.listening = False
+        super(Postgres, self).join(timeout)
+
+
+class UnixSocket(BaseEngine):
+    """
+    Engine relying on Unix domain datagram sockets to deliver messages
+    between processes of the same host without an external broker.
+
+    Every engine binds a socket in the `path` directory and publishes by
+    sending a datagram to all the sockets found in this directory. Since any
+    process allowed to write in it can inject checksum changes the directory
+    must be owned by the current user and inaccessible to others.
+    """
+
+    batch_size = 100
+    max_size = 65536
+
+    def __init__(self, initialize, callback, path=None, timeout=1):
+        super(UnixSocket, self).__init__(initialize, callback)
+        self.path = path or os.path.join(tempfile.gettempdir(), "mutant-state-%d" % os.getuid())
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._check_path()
+        self.address = os.path.join(self.path, "%d-%s.sock" % (os.getpid(), uuid.uuid4().hex[:8]))
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.address)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.settimeout(timeout)
+        self.listening = True
+
+    def _check_path(self):
+        path_stat = os.lstat(self.path)
+        if not stat.S_ISDIR(path_stat.st_mode):
+            raise ImproperlyConfigured("%s is not a directory." % self.path)
+        if path_stat.st_uid != os.getuid():
+            raise ImproperlyConfigured("%s is not owned by the current user." % self.path)
+        if path_stat.st_mode & 0o077:
+            raise ImproperlyConfigured("%s must not be accessible to other users." % self.path)
+
+    def run(self):
+        self._initialize()
+        try:
+            while self.listening:
+                data = self.socket.recv(self.max_size)
+                # Empty datagrams are used to wake up the listening loop.
+                if data:
+                    for args in json.loads(force_str(data)):
+                        self.callback(*args)
+        finally:
+            self.socket.close()
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _send(self, messages):
+        data = force_bytes(json.dumps(messages))
+        for name in os.listdir(self.path):
+            if not name.endswith('.sock'):
+                continue
+            address = os.path.join(self.path, name)
+            try:
+                self.sender.sendto(data, address)
+            except socket.timeout:
+                logger.warning('Timed out delivering %d messages to %s.', len(messages), address)
+            except socket.error as e:
+                if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                    raise
+                # Remove sockets left behind by processes that are gone.
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+
+    def publish(self, *args):
+        self._send([list(args)])
+
+    def publish_many(self, messages):
+        messages = [list(args) for args in messages]
+        for start in range(0, len(messages), self.batch_size):
+            self._send(messages[start:start + self.batch_size])
+
+    def join(self, timeout=None):
+        if self.listening:
+            self.listening = False
+            self.sender.sendto(b'', self.address)
+        super(UnixSocket, self).join(timeout)
@@ -1,10 +1,12 @@
 from __future__ import unicode_literals
 
+import sys
 from collections import defaultdict
 from contextlib import contextmanager
 from copy import deepcopy
 from itertools import chain, groupby
 from operator import itemgetter
+from threading import Event, Lock, current_thread
 
 from django.apps import AppConfig, apps
 from django.db import connections, models, router
@@ -59,6 +61,79 @@ def get_db_table(app_label, model):
     return "mutant_%s_%s" % (app_label, model)
 
 
+class SingleFlight(object):
+    """
+    Make sure only one thread performs a call for a given key at a time while
+    concurrent callers wait for it to complete and reuse its result.
+
+    A caller that would deadlock by waiting, either because it's the thread
+    performing the call or because the thread performing it is waiting on
+    the caller, performs the call itself. So does a caller that waited for
+    more than `timeout` seconds.
+    """
+
+    class Flight(object):
+        def __init__(self, owner):
+            self.owner = owner
+            self.event = Event()
+            self.result = None
+            self.failed = False
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = {}
+        self.waiting = {}
+
+    def _would_deadlock(self, flight, thread):
+        owners = set()
+        owner = flight.owner
+        while owner not in owners:
+            if owner is thread:
+                return True
+            owners.add(owner)
+            key = self.waiting.get(owner)
+            if key is None or key not in self.flights:
+                return False
+            owner = self.flights[key].owner
+        return False
+
+    def run(self, key, func, join=True, timeout=None):
+        """
+        Call `func` unless a call for `key` is in flight. When `join` is False
+        the result of a call in flight is not reused; `func` is called once it
+        completes instead.
+        """
+        thread = current_thread()
+        while True:
+            with self.lock:
+                flight = self.flights.get(key)
+                if flight is None:
+                    flight = self.flights[key] = self.Flight(thread)
+                    break
+                if self._would_deadlock(flight, thread):
+                    return func()
+                self.waiting[thread] = key
+            try:
+                completed = flight.event.wait(timeout)
+            finally:
+                with self.lock:
+                    del self.waiting[thread]
+            if not completed:
+                return func()
+            if join and not flight.failed:
+                return flight.result
+        try:
+            flight.result = func()
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result
+
+
 @contextmanager
 def apps_lock():
     # The registry lock is not re-entrant so we must avoid acquiring it
@@ -70,6 +145,36 @@ def apps_lock():
         yield
 
 
+@contextmanager
+def targeted_cache_expiry(apps=apps):
+    """
+    Prevent the registration of models in `apps` from expiring the `_meta`
+    caches of all the registered models. The registered model classes must be
+    passed to `expire_related_caches()` instead.
+    """
+    with apps_lock():
+        apps.clear_cache = apps.get_models.cache_clear
+        try:
+            yield
+        finally:
+            del apps.clear_cache
+
+
+def expire_related_caches(model_class):
+    """
+    Expire the `_meta` caches of `model_class` and of the models it's related
+    to which are the only ones affected by its (un)registration.
+    """
+    opts = model_class._meta
+    opts.apps.get_models.cache_clear()
+    opts._expire_cache()
+    for field in get_foward_fields(opts):
+        if field.model is model_class and get_remote_field(field):
+            remote_field_model = get_remote_field_model(field)
+            if isinstance(remote_field_model, models.base.ModelBase):
+                clear_opts_related_cache(remote_field_model)
+
+
 def remove_from_app_cache(model_class, quiet=False):
     opts = model_class._meta
     apps = opts.apps
@@ -80,11 +185,38 @@ def remove_from_app_cache(model_class, quiet=False):
         except KeyError:
             if not quiet:
                 raise ValueError("%r is not cached" % model_class)
-        apps.clear_cache()
+        if hasattr(model_class, '_definition'):
+            from .db.models import mutable_model_registry
+            mutable_model_registry.unregister(model_class)
+        expire_related_caches(model_class)
         unreference_model(model_class)
     return model_class
 
 
+def get_model_class_size(model_class):
+    """
+    Return an estimate of the memory retained by `model_class` in bytes
+    accounting for the model class itself, its options, fields, relations
+    and managers along with their attributes.
+    """
+    opts = model_class._meta
+    objects = [model_class, opts] + list(opts.managers)
+    for field in opts.local_fields + opts.local_many_to_many:
+        objects.append(field)
+        remote_field = get_remote_field(field)
+        if remote_field:
+            objects.append(remote_field)
+    seen = set()
+    size = 0
+    for obj in objects:
+        attrs = vars(obj)
+        for value in chain([obj, attrs], attrs.values()):
+            if id(value) not in seen:
+                seen.add(id(value))
+                size += sys.getsizeof(value)
+    return size
+
+
 def get_foward_fields(opts):
     return chain(
         opts.fields,
@@ -97,13 +229,9 @@ def get_reverse_fields(opts):
 
 
 def clear_opts_related_cache(model_class):
-    opts = model_class._meta
-    children = [
-        related_object.related_model
-        for related_object in opts.__dict__.get('related_objects', []) if related_object.parent_link
-    ]
-    opts._expire_cache()
-    for child in children:
+    model_class._meta._expire_cache()
+    # Subclasses inherit the reverse relations of their parents.
+    for child in model_class.__subclasses__():
         clear_opts_related_cache(child)
 
 
@@ -160,12 +288,15 @@ def app_cache_restorer():
     A context manager that restore model cache state as it was before
     entering context.
     """
+    from .db.models import mutable_model_registry
     state = _app_cache_deepcopy(apps.__dict__)
+    snapshot = mutable_model_registry.snapshot
     try:
         yield state
     finally:
         with apps_lock():
             apps.__dict__ = state
+            mutable_model_registry.restore(snapshot)
             # Rebind the app registry models cache to
             # individual app config ones.
             for app_conf in apps.get_app_configs():
@@ -19,7 +19,7 @@ setup(
         'django-picklefield>=0.3.2',
         'django-polymodels>=1.4.6a3',
     ],
-    packages=find_packages(exclude=['tests', 'tests.*']),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
     package_data={
         '': ['locale/*/LC_MESSAGES/*'],
     },
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 import json
 from tempfile import NamedTemporaryFile
 
+from django.apps import apps
 from django.core.management import call_command
 from django.core.serializers.base import DeserializationError
 from django.core.serializers.json import Serializer as JSONSerializer
@@ -94,3 +95,17 @@ class LoadDataTestCase(DataCommandTestCase):
                 call_command(
                     'loaddata', stream.name, stdout=StringIO()
                 )
+
+
+class WarmUpTestCase(DataCommandTestCase):
+    def test_warm_up(self):
+        """
+        Make sure mutable model classes are constructed and the duration of
+        each phase is reported when calling `warmup`.
+        """
+        remove_from_app_cache(self.model_cls)
+        output = StringIO()
+        call_command('warmup', 'mutant', stdout=output)
+        phases = [line.split(':')[0] for line in output.getvalue().splitlines()]
+        self.assertEqual(phases, ['load', 'sort', 'state', 'render'])
+        self.assertIs(apps.get_model('mutant', 'Model'), self.model_def.model_class().model)
@@ -2,6 +2,8 @@ from __future__ import unicode_literals
 
 from unittest import skip
 
+from django.apps import apps
+from django.contrib.auth.models import Group
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
@@ -9,11 +11,17 @@ from django.db.models.deletion import ProtectedError
 from django.db.models.fields import FieldDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 
+from mutant import settings
 from mutant.compat import get_remote_field_model
 from mutant.contrib.related.models import (
     ForeignKeyDefinition, ManyToManyFieldDefinition, OneToOneFieldDefinition,
 )
+from mutant.contrib.text.models import CharFieldDefinition
+from mutant.db.models import (
+    RenderedStateCache, checksum_lookups, rendered_states,
+)
 from mutant.models import BaseDefinition, ModelDefinition
+from mutant.state import handler as state_handler
 from mutant.test.testcases import FieldDefinitionTestMixin
 from mutant.utils import app_cache_restorer, get_reverse_fields
 
@@ -225,6 +233,181 @@ class ForeignKeyDefinitionOnDeleteTest(BaseModelDefinitionTestCase):
         self.assertEqual(Model.objects.get(pk=obj2.pk).f1.pk, default)
 
 
+class RenderedStateTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(RenderedStateTest, self).setUp()
+        self.related_model_def = ModelDefinition.objects.create(
+            app_label='related', object_name='RelatedModel'
+        )
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def, name='related', null=True,
+            to=self.related_model_def.model_ct,
+        )
+
+    def get_related_model(self, model):
+        return get_remote_field_model(model._meta.get_field('related'))
+
+    def test_related_states_reused(self):
+        model_class = self.model_def.model_class()
+        rendered = model_class.render_state()
+        self.assertIs(model_class.render_state(), rendered)
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        altered_rendered = model_class.render_state()
+        self.assertIsNot(altered_rendered, rendered)
+        self.assertEqual(altered_rendered._meta.get_field('name').max_length, 10)
+        self.assertIs(self.get_related_model(altered_rendered), self.get_related_model(rendered))
+
+    def test_related_states_change(self):
+        model_class = self.model_def.model_class()
+        rendered = model_class.render_state()
+        CharFieldDefinition.objects.create(model_def=self.related_model_def, name='name', max_length=10)
+        altered_rendered = model_class.render_state()
+        related_model = self.get_related_model(altered_rendered)
+        self.assertIsNot(related_model, self.get_related_model(rendered))
+        self.assertEqual(related_model._meta.get_field('name').max_length, 10)
+
+    def test_incoming_relations(self):
+        related_model_class = self.related_model_def.model_class()
+        rendered = related_model_class.render_state()
+        CharFieldDefinition.objects.create(model_def=self.related_model_def, name='name', max_length=10)
+        altered_rendered = related_model_class.render_state()
+        self.assertIsNot(altered_rendered, rendered)
+        self.assertEqual(altered_rendered._meta.get_field('name').max_length, 10)
+        # Reverse relations must be available and point to the rendering.
+        related_objects = altered_rendered._meta.related_objects
+        self.assertEqual([rel.field.name for rel in related_objects], ['related'])
+        self.assertIs(get_remote_field_model(related_objects[0].field), altered_rendered)
+        self.assertEqual(related_objects[0].related_model._meta.model_name, 'model')
+
+    def test_incoming_relations_reused(self):
+        related_model_class = self.related_model_def.model_class()
+        rendered = related_model_class.render_state()
+        related_states = rendered_states.entries[related_model_class._definition]['related_states']
+        self.assertIs(related_model_class.render_state(), rendered)
+        CharFieldDefinition.objects.create(model_def=self.related_model_def, name='name', max_length=10)
+        related_model_class.render_state()
+        self.assertIs(rendered_states.entries[related_model_class._definition]['related_states'], related_states)
+
+    def test_incoming_relations_change(self):
+        related_model_class = self.related_model_def.model_class()
+        related_model_class.render_state()
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        related_objects = related_model_class.render_state()._meta.related_objects
+        self.assertEqual(related_objects[0].related_model._meta.get_field('name').max_length, 10)
+
+    def test_deleted_definition_discarded(self):
+        related_model_class = self.related_model_def.model_class()
+        related_model_class.render_state()
+        definition = self.model_def.model_class()._definition
+        self.model_def.delete()
+        self.assertNotIn(definition, rendered_states.entries)
+        self.assertNotIn(related_model_class._definition, rendered_states.entries)
+        self.assertFalse(related_model_class.render_state()._meta.related_objects)
+
+    def test_bounded(self):
+        cache = RenderedStateCache(size=1)
+        model_class = self.model_def.model_class()
+        related_model_class = self.related_model_def.model_class()
+        cache.render(model_class, model_class.get_model_state())
+        cache.render(related_model_class, related_model_class.get_model_state())
+        self.assertEqual(list(cache.entries), [related_model_class._definition])
+
+
+class DependencyInvalidationTest(BaseModelDefinitionTestCase):
+    def create_dependent(self, object_name, to):
+        model_def = ModelDefinition.objects.create(app_label='related', object_name=object_name)
+        ForeignKeyDefinition.objects.create(model_def=model_def, name='fk', null=True, to=to.model_ct)
+        return model_def
+
+    def test_mark_as_obsolete_num_queries(self):
+        dependents = [self.create_dependent("Dependent%d" % i, self.model_def) for i in range(5)]
+        model_classes = [dependent.model_class().model for dependent in dependents]
+        hub = self.model_def.model_class()
+        with self.assertNumQueries(0):
+            hub.mark_as_obsolete()
+        for model_class in model_classes:
+            self.assertTrue(model_class._is_obsolete)
+        # Dependents are lazily rebuilt on access.
+        dependents[0].model_class().objects.create()
+
+    def test_mark_as_obsolete_cycle(self):
+        first_def = self.create_dependent('First', self.model_def)
+        second_def = self.create_dependent('Second', first_def)
+        ForeignKeyDefinition.objects.create(model_def=first_def, name='second', null=True, to=second_def.model_ct)
+        first = first_def.model_class().model
+        second = second_def.model_class().model
+        with self.assertNumQueries(0):
+            first.mark_as_obsolete()
+        self.assertTrue(second._is_obsolete)
+
+
+class RelatedObsolescenceTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(RelatedObsolescenceTest, self).setUp()
+        self._staleness_window = settings.STATE_STALENESS_WINDOW
+        settings.STATE_STALENESS_WINDOW = 60
+        self.addCleanup(setattr, settings, 'STATE_STALENESS_WINDOW', self._staleness_window)
+        handler = apps.get_app_config('mutant').state_handler
+        get_many_checksums = handler.get_many_checksums
+        self.lookups = []
+
+        def record_get_many_checksums(definition_pks):
+            self.lookups.append(sorted(definition_pks))
+            return get_many_checksums(definition_pks)
+        handler.get_many_checksums = record_get_many_checksums
+        self.addCleanup(delattr, handler, 'get_many_checksums')
+
+    def test_related_models_checked_together(self):
+        first_def = ModelDefinition.objects.create(app_label='related', object_name='First')
+        ForeignKeyDefinition.objects.create(model_def=first_def, name='fk', null=True, to=self.model_def.model_ct)
+        second_def = ModelDefinition.objects.create(app_label='related', object_name='Second')
+        ForeignKeyDefinition.objects.create(model_def=second_def, name='first', null=True, to=first_def.model_ct)
+        model_classes = [
+            model_def.model_class().model for model_def in (second_def, first_def, self.model_def)
+        ]
+        for model_class in model_classes:
+            model_class._checksum_checked_at = None
+        del self.lookups[:]
+        checksum_lookups.reset()
+        for model_class in model_classes:
+            self.assertFalse(model_class.is_obsolete())
+        self.assertEqual(self.lookups, [sorted([second_def.pk, first_def.pk, self.model_def.pk])])
+        self.assertEqual(checksum_lookups.performed, 1)
+        self.assertEqual(checksum_lookups.avoided, 2)
+
+    def test_obsolete_related_model(self):
+        first_def = ModelDefinition.objects.create(app_label='related', object_name='First')
+        ForeignKeyDefinition.objects.create(model_def=first_def, name='fk', null=True, to=self.model_def.model_ct)
+        first = first_def.model_class().model
+        model_class = self.model_def.model_class().model
+        first._checksum_checked_at = model_class._checksum_checked_at = None
+        state_handler.set_checksum(self.model_def.pk, 'remote')
+        self.assertFalse(first.is_obsolete())
+        self.assertTrue(model_class.is_obsolete())
+
+
+class TargetedCacheExpiryTest(BaseModelDefinitionTestCase):
+    def get_related_models(self, model):
+        return [field.related_model for field in model._meta.get_fields(include_hidden=True) if field.auto_created]
+
+    def test_rebuild(self):
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def, name='content_type', null=True, to=ContentType.objects.get_for_model(ContentType)
+        )
+        model_class = self.model_def.model_class().model
+        Group._meta.get_fields()
+        self.assertTrue(Group._meta._get_fields_cache)
+        self.assertIn(model_class, self.get_related_models(ContentType))
+        new_model_class = self.model_def.model_class(force_create=True).model
+        # Caches of unrelated models are left untouched.
+        self.assertTrue(Group._meta._get_fields_cache)
+        related_models = self.get_related_models(ContentType)
+        self.assertNotIn(model_class, related_models)
+        self.assertIn(new_model_class, related_models)
+        # Subclasses inherit the reverse relations of their parents.
+        self.assertIn(new_model_class, self.get_related_models(ModelDefinition))
+
+
 class OneToOneFieldDefinitionTests(BaseModelDefinitionTestCase):
     def test_parent_link_to_mutable_model(self):
         first_model_def = self.model_def
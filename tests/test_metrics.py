@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+
+from django.apps import apps
+from django.test import SimpleTestCase
+
+from mutant.contrib.text.models import CharFieldDefinition
+from mutant.metrics import MemoryMetrics, metrics
+
+from .utils import BaseModelDefinitionTestCase
+
+
+class MemoryMetricsTest(SimpleTestCase):
+    def test_aggregation(self):
+        backend = MemoryMetrics()
+        backend.increment('count', definition=1)
+        backend.increment('count', 2, definition=2)
+        with backend.timer('timing', operation='create_model'):
+            pass
+        backend.timing('timing', 0.5, operation='delete_model')
+        self.assertEqual(backend.get_count('count'), 3)
+        self.assertEqual(backend.get_count('count', definition=2), 2)
+        self.assertEqual(len(backend.get_timings('timing')), 2)
+        self.assertEqual(backend.get_timings('timing', operation='delete_model'), [0.5])
+        backend.reset()
+        self.assertEqual(backend.get_count('count'), 0)
+
+
+class InstrumentationTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        mutant_config = apps.get_app_config('mutant')
+        self.addCleanup(setattr, mutant_config, 'metrics', mutant_config.metrics)
+        mutant_config.metrics = MemoryMetrics()
+
+    def test_field_addition(self):
+        model_class = self.model_def.model_class().model
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        self.model_def.model_class()
+        self.assertEqual(metrics.get_count('model_class.obsolete', definition=self.model_def.pk), 1)
+        self.assertTrue(model_class._is_obsolete)
+        self.assertEqual(len(metrics.get_timings('schema.ddl', operation='add_field')), 1)
+        self.assertEqual(len(metrics.get_timings('model_class.construct', definition=self.model_def.pk)), 1)
+        self.assertEqual(len(metrics.get_timings('checksum.compute', definition=self.model_def.pk)), 1)
+        # The rendering of the state used to alter the schema might be cached.
+        self.assertGreaterEqual(len(metrics.get_timings('model_state.render', model='mutant.Model')), 1)
+        self.assertEqual(len(metrics.get_timings('state_handler.set')), 1)
+        self.assertGreater(len(metrics.get_timings('state_handler.get')), 0)
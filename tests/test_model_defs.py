@@ -1,25 +1,47 @@
 from __future__ import unicode_literals
 
+import os
 import pickle
+import tempfile
+import threading
 from unittest.case import expectedFailure
 
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
 from django.core.exceptions import ValidationError
 from django.core.management import call_command
 from django.db import connection, connections, models, router, transaction
+from django.db.migrations.state import ModelState
 from django.db.utils import IntegrityError
+from django.http import HttpResponse
+from django.test.client import RequestFactory
 from django.test.utils import CaptureQueriesContext
 from django.utils.translation import ugettext as _
 
+import mutant
+from mutant import settings
 from mutant.compat import many_to_many_set
 from mutant.contrib.related.models import ForeignKeyDefinition
 from mutant.contrib.text.models import CharFieldDefinition
-from mutant.db.models import MutableModel
+from mutant.db.models import (
+    MutableModel, cache_model_resolution, checksum_lookups,
+    invalidate_model_resolution, model_resolution_cache,
+    mutable_model_registry,
+)
+from mutant.management import schema_alteration
+from mutant.middleware import ModelResolutionCacheMiddleware
+from mutant.models import FieldDefinitionChoice
 from mutant.models.model import (
     BaseDefinition, ModelDefinition, MutableModelProxy,
-    OrderingFieldDefinition, UniqueTogetherDefinition,
+    OrderingFieldDefinition, UniqueTogetherDefinition, evict_model_classes,
+)
+from mutant.signals import mutable_class_prepared
+from mutant.state import handler as state_handler
+from mutant.utils import (
+    SingleFlight, app_cache_restorer, clear_opts_related_cache,
+    get_model_class_size, remove_from_app_cache,
 )
-from mutant.utils import clear_opts_related_cache, remove_from_app_cache
 
 from .models import (
     AbstractConcreteModelSubclass, AbstractModel, Mixin,
@@ -85,6 +107,25 @@ class ModelDefinitionTest(BaseModelDefinitionTestCase):
         db, table_name = self.get_model_db_table_name(self.model_def)
         self.assertTableExists(db, table_name)
 
+    def test_content_type_cache_eviction(self):
+        unrelated = ContentType.objects.get_for_model(ModelDefinition)
+        ContentType.objects.get_for_id(self.model_def.pk)
+        self.model_def.object_name = 'MyModel'
+        self.model_def.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(ContentType.objects.get_for_model(ModelDefinition), unrelated)
+            self.assertEqual(ContentType.objects.get_for_id(unrelated.pk), unrelated)
+        with self.assertNumQueries(1):
+            self.assertEqual(ContentType.objects.get_for_id(self.model_def.pk).model, 'mymodel')
+        with self.assertRaises(ContentType.DoesNotExist):
+            ContentType.objects.get_by_natural_key('mutant', 'model')
+        pk = self.model_def.pk
+        self.model_def.delete()
+        with self.assertRaises(ContentType.DoesNotExist):
+            ContentType.objects.get_for_id(pk)
+        with self.assertNumQueries(0):
+            ContentType.objects.get_for_id(unrelated.pk)
+
     def test_db_table_change(self):
         """Asserts that the `db_table` field is correctly handled."""
         db, table_name = self.get_model_db_table_name(self.model_def)
@@ -134,6 +175,9 @@ class ModelDefinitionTest(BaseModelDefinitionTestCase):
         )
         # and their column is created.
         self.assertModelTablesColumnExists(MyFixtureModel, 'fixture_integerfieldcolumn')
+        # Deserialized definitions don't register model classes without an
+        # app label.
+        self.assertNotIn('', apps.all_models)
 
     def test_verbose_name(self):
         model_class = self.model_def.model_class()
@@ -239,6 +283,398 @@ class ModelDefinitionTest(BaseModelDefinitionTestCase):
         new_model_def.save()
 
 
+class ModelDefinitionStateTest(BaseModelDefinitionTestCase):
+    def create_definition(self, object_name, field_count):
+        model_def = ModelDefinition.objects.create(
+            app_label='mutant', object_name=object_name,
+            bases=[BaseDefinition(base=Mixin)],
+        )
+        field_defs = []
+        for i in range(field_count):
+            field_def = CharFieldDefinition.objects.create(
+                model_def=model_def, name="field%d" % i, max_length=10
+            )
+            FieldDefinitionChoice.objects.create(
+                field_def=field_def, value='value', label='label'
+            )
+            field_defs.append(field_def)
+        unique_together = UniqueTogetherDefinition.objects.create(model_def=model_def)
+        many_to_many_set(unique_together, 'field_defs', field_defs[:2])
+        OrderingFieldDefinition.objects.create(model_def=model_def, lookup='field0')
+        return ModelDefinition.objects.get(pk=model_def.pk)
+
+    def get_state_queries(self, model_def):
+        with CaptureQueriesContext(connection) as captured_queries:
+            state = model_def.get_state()
+        return state, len(captured_queries)
+
+    def test_get_state_num_queries(self):
+        """Building a state shouldn't issue a query per field definition."""
+        small_def = self.create_definition('SmallModel', 2)
+        large_def = self.create_definition('LargeModel', 15)
+        small_state, small_queries = self.get_state_queries(small_def)
+        large_state, large_queries = self.get_state_queries(large_def)
+        self.assertEqual(small_queries, 6)
+        self.assertEqual(small_queries, large_queries)
+        self.assertEqual(len(large_state.fields), 15)
+        self.assertEqual(large_state.options['ordering'], ('field0',))
+        self.assertEqual(large_state.options['unique_together'], [('field0', 'field1')])
+        self.assertEqual(dict(large_state.fields)['field0'].choices, (('value', 'label'),))
+
+    def test_prefetch_state(self):
+        """Definitions retrieved in bulk can build their state without any
+        further queries."""
+        self.create_definition('SmallModel', 2)
+        self.create_definition('LargeModel', 15)
+        model_defs = list(
+            ModelDefinition.objects.filter(
+                object_name__in=['SmallModel', 'LargeModel']
+            ).prefetch_state()
+        )
+        with self.assertNumQueries(0):
+            states = [model_def.get_state() for model_def in model_defs]
+        self.assertEqual(
+            sorted(len(state.fields) for state in states), [2, 15]
+        )
+        # Prefetched data is only used once to prevent stale states.
+        _state, num_queries = self.get_state_queries(model_defs[0])
+        self.assertEqual(num_queries, 6)
+
+
+class ModelDefinitionRevisionTest(BaseModelDefinitionTestCase):
+    def get_revision(self):
+        return ModelDefinition.objects.get(pk=self.model_def.pk).revision
+
+    def assertRevisionBumped(self, revision):
+        self.assertGreater(self.get_revision(), revision)
+        return self.get_revision()
+
+    def test_attribute_changes_bump_revision(self):
+        revision = self.get_revision()
+        field_def = CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='name', max_length=10
+        )
+        revision = self.assertRevisionBumped(revision)
+        choice = FieldDefinitionChoice.objects.create(
+            field_def=field_def, value='value', label='label'
+        )
+        revision = self.assertRevisionBumped(revision)
+        choice.delete()
+        revision = self.assertRevisionBumped(revision)
+        field_def.delete()
+        revision = self.assertRevisionBumped(revision)
+        self.model_def.verbose_name = 'revised'
+        self.model_def.save()
+        self.assertRevisionBumped(revision)
+
+    def test_raw_attribute_saves_bump_revision(self):
+        """Attributes loaded from fixtures don't go through their `save()`."""
+        field_def = CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='name', max_length=10
+        )
+        attributes = [
+            OrderingFieldDefinition(model_def=self.model_def, lookup='name', order=1),
+            BaseDefinition(model_def=self.model_def, base=Mixin, order=1),
+            UniqueTogetherDefinition(model_def=self.model_def),
+            FieldDefinitionChoice(field_def=field_def, value='value', label='label', order=1),
+            field_def,
+        ]
+        for attribute in attributes:
+            revision = self.get_revision()
+            model_class = self.model_def.model_class().model
+            models.Model.save_base(attribute, raw=True)
+            self.assertRevisionBumped(revision)
+            self.assertTrue(model_class.is_obsolete())
+
+    def test_raw_definition_saves_bump_revision(self):
+        """Definitions loaded from fixtures don't go through their `save()`."""
+        self.model_def.bump_revision()
+        revision = self.get_revision()
+        checksum = self.model_def.model_class().checksum()
+        fixture = tempfile.NamedTemporaryFile(suffix='.json', mode='w', delete=False)
+        self.addCleanup(os.unlink, fixture.name)
+        with fixture:
+            # The revision loaded from the fixture is older than the stored one.
+            fixture.write(serializers.serialize('json', [self.model_def], fields=['object_name']))
+        call_command('loaddata', fixture.name, verbosity=0)
+        self.assertEqual(self.get_revision(), revision + 1)
+        self.assertNotEqual(self.model_def.model_class().checksum(), checksum)
+
+    def test_checksum_tracks_revision(self):
+        model_class = self.model_def.model_class()
+        checksum = model_class.checksum()
+        self.assertEqual(model_class.model._revision, self.model_def.revision)
+        CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='name', max_length=10
+        )
+        self.assertNotEqual(self.model_def.model_class().checksum(), checksum)
+
+    def test_current_model_class_reuse(self):
+        """Reconstructing a model class whose definition wasn't altered should
+        only require the revision to be looked up."""
+        existing_model_class = self.model_def.model_class().model
+        existing_model_class.mark_as_obsolete()
+        model_def = ModelDefinition.objects.get(pk=self.model_def.pk)
+        with self.assertNumQueries(1):
+            model_class = model_def.construct(existing_model_class=existing_model_class)
+        self.assertIs(model_class, existing_model_class)
+        self.assertFalse(model_class.is_obsolete())
+
+
+class ModelDefinitionWarmUpTest(BaseModelDefinitionTestCase):
+    def test_warm_up(self):
+        CharFieldDefinition.objects.create(
+            model_def=self.model_def, name='name', max_length=10
+        )
+        child_def = ModelDefinition.objects.create(
+            app_label='mutant', object_name='ChildModel'
+        )
+        BaseDefinition.objects.create(
+            model_def=child_def, base=self.model_def.model_class()
+        )
+        model_classes = [model_def.model_class().model for model_def in (self.model_def, child_def)]
+        for model_class in model_classes:
+            remove_from_app_cache(model_class).mark_as_obsolete()
+        prepared = []
+
+        def record_prepared(sender, definition, **kwargs):
+            prepared.append(definition.pk)
+
+        mutable_class_prepared.connect(record_prepared)
+        try:
+            # Mutable bases are not resolved through additional queries.
+            with self.assertNumQueries(8):
+                timings = ModelDefinition.objects.warm_up()
+            # Definitions with a current model class are skipped.
+            ModelDefinition.objects.warm_up()
+        finally:
+            mutable_class_prepared.disconnect(record_prepared)
+        self.assertEqual(list(timings), ['load', 'sort', 'state', 'render'])
+        # Bases must be constructed before their subclasses.
+        self.assertEqual(prepared, [self.model_def.pk, child_def.pk])
+        for model_def in (self.model_def, child_def):
+            model_class = model_def.model_class()
+            self.assertEqual(state_handler.get_checksum(model_def.pk), model_class.checksum())
+        self.assertTrue(issubclass(child_def.model_class(), self.model_def.model_class().model))
+        # Subclasses must inherit from the registered base model class.
+        self.assertIn(self.model_def.model_class().model, child_def.model_class().model.__bases__)
+
+
+class DeferRebuildsTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(DeferRebuildsTest, self).setUp()
+        self.prepared = []
+        mutable_class_prepared.connect(self.record_prepared)
+        self.addCleanup(mutable_class_prepared.disconnect, self.record_prepared)
+        handler = apps.get_app_config('mutant').state_handler
+        set_checksum = handler.set_checksum
+        self.published = []
+
+        def record_set_checksum(definition_pk, checksum):
+            self.published.append(definition_pk)
+            return set_checksum(definition_pk, checksum)
+        handler.set_checksum = record_set_checksum
+        self.addCleanup(delattr, handler, 'set_checksum')
+
+    def record_prepared(self, sender, definition, **kwargs):
+        self.prepared.append(definition.pk)
+
+    def test_coalesced_rebuilds(self):
+        model_class = self.model_def.model_class()
+        with mutant.defer_rebuilds():
+            field_defs = [
+                CharFieldDefinition.objects.create(
+                    model_def=self.model_def, name="field%d" % i, max_length=10
+                ) for i in range(10)
+            ]
+            for field_def in field_defs[:5]:
+                FieldDefinitionChoice.objects.create(field_def=field_def, value='a', label='A')
+            field_defs[-1].delete()
+            with mutant.defer_rebuilds():
+                OrderingFieldDefinition.objects.create(model_def=self.model_def, lookup='field0')
+            self.assertEqual(self.prepared, [])
+            self.assertEqual(self.published, [])
+            # Alterations are performed immediately.
+            self.assertModelTablesColumnExists(model_class, 'field0')
+        self.assertEqual(self.prepared, [self.model_def.pk])
+        self.assertEqual(self.published, [self.model_def.pk])
+        opts = model_class._meta
+        self.assertEqual(
+            [field.name for field in opts.fields],
+            ['id'] + ["field%d" % i for i in range(9)]
+        )
+        self.assertEqual(opts.get_field('field4').choices, [('a', 'A')])
+        self.assertEqual(opts.ordering, ('field0',))
+        model_class.objects.create(field0='a', field8='b')
+
+    def test_exception(self):
+        model_class = self.model_def.model_class()
+        with self.assertRaises(ValueError):
+            with mutant.defer_rebuilds():
+                CharFieldDefinition.objects.create(model_def=self.model_def, name='field', max_length=10)
+                raise ValueError
+        self.assertEqual(self.prepared, [])
+        self.assertIn('field', [field.name for field in model_class._meta.fields])
+
+    def test_nested_exception(self):
+        other_def = ModelDefinition.objects.create(app_label='mutant', object_name='OtherModel')
+        other_model_class = other_def.model_class().model
+        del self.prepared[:], self.published[:]
+        with mutant.defer_rebuilds():
+            CharFieldDefinition.objects.create(model_def=self.model_def, name='field', max_length=10)
+            with self.assertRaises(ValueError):
+                with mutant.defer_rebuilds():
+                    CharFieldDefinition.objects.create(model_def=other_def, name='field', max_length=10)
+                    raise ValueError
+            # Only the definitions altered by the failed block are discarded.
+            self.assertTrue(other_model_class.is_obsolete())
+            self.assertEqual(list(schema_alteration.definitions), [self.model_def.pk])
+        self.assertEqual(self.prepared, [self.model_def.pk])
+        self.assertIn('field', [field.name for field in self.model_def.model_class()._meta.fields])
+        self.assertIn('field', [field.name for field in other_def.model_class()._meta.fields])
+
+    def test_base_exception(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with ModelDefinition.objects.bulk_alter():
+                CharFieldDefinition.objects.create(model_def=self.model_def, name='field', max_length=10)
+                raise KeyboardInterrupt
+        self.assertFalse(schema_alteration.active)
+        self.assertEqual(schema_alteration.queueing, 0)
+        self.assertEqual(schema_alteration.operations, [])
+        self.assertEqual(schema_alteration.definitions, {})
+
+
+class BulkAlterTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(BulkAlterTest, self).setUp()
+        self.prepared = []
+        mutable_class_prepared.connect(self.record_prepared)
+        self.addCleanup(mutable_class_prepared.disconnect, self.record_prepared)
+
+    def record_prepared(self, sender, definition, **kwargs):
+        self.prepared.append(definition.pk)
+
+    def test_add_fields(self):
+        model_class = self.model_def.model_class()
+        with ModelDefinition.objects.bulk_alter():
+            for i in range(30):
+                CharFieldDefinition.objects.create(
+                    model_def=self.model_def, name="field%d" % i, max_length=10
+                )
+            self.assertModelTablesColumnDoesntExists(model_class, 'field0')
+            self.assertEqual(self.prepared, [])
+        self.assertEqual(self.prepared, [self.model_def.pk])
+        for i in range(30):
+            self.assertModelTablesColumnExists(model_class, "field%d" % i)
+        model_class.objects.create(field0='a', field29='b')
+
+    def test_alter_and_remove_fields(self):
+        f1 = CharFieldDefinition.objects.create(model_def=self.model_def, name='f1', max_length=10)
+        f2 = CharFieldDefinition.objects.create(model_def=self.model_def, name='f2', max_length=10)
+        model_class = self.model_def.model_class()
+        del self.prepared[:]
+        with ModelDefinition.objects.bulk_alter():
+            f1.name = 'f1_renamed'
+            f1.save()
+            FieldDefinitionChoice.objects.create(field_def=f1, value='a', label='A')
+            f2.delete()
+            CharFieldDefinition.objects.create(model_def=self.model_def, name='f3', max_length=10)
+            f1.max_length = 20
+            f1.save()
+        self.assertEqual(self.prepared, [self.model_def.pk])
+        self.assertModelTablesColumnExists(model_class, 'f1_renamed')
+        self.assertModelTablesColumnExists(model_class, 'f3')
+        self.assertModelTablesColumnDoesntExists(model_class, 'f1')
+        self.assertModelTablesColumnDoesntExists(model_class, 'f2')
+        field = model_class._meta.get_field('f1_renamed')
+        self.assertEqual(field.max_length, 20)
+        self.assertEqual(field.choices, [('a', 'A')])
+
+    def test_unique_together(self):
+        model_class = self.model_def.model_class()
+        with ModelDefinition.objects.bulk_alter():
+            f1 = CharFieldDefinition.objects.create(model_def=self.model_def, name='f1', max_length=10)
+            f2 = CharFieldDefinition.objects.create(model_def=self.model_def, name='f2', max_length=10)
+            unique_together = UniqueTogetherDefinition.objects.create(model_def=self.model_def)
+            many_to_many_set(unique_together, 'field_defs', [f1, f2])
+        self.assertEqual(self.prepared, [self.model_def.pk])
+        model_class.objects.create(f1='a', f2='b')
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            model_class.objects.create(f1='a', f2='b')
+
+    def test_rollback(self):
+        model_class = self.model_def.model_class()
+        with self.assertRaises(ValueError):
+            with ModelDefinition.objects.bulk_alter():
+                CharFieldDefinition.objects.create(model_def=self.model_def, name='f1', max_length=10)
+                raise ValueError
+        self.assertEqual(self.prepared, [])
+        self.assertFalse(self.model_def.fielddefinitions.exists())
+        self.assertModelTablesColumnDoesntExists(model_class, 'f1')
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='f1', max_length=10)
+        self.assertModelTablesColumnExists(model_class, 'f1')
+
+    def test_nested_rollback(self):
+        model_class = self.model_def.model_class()
+        with ModelDefinition.objects.bulk_alter():
+            CharFieldDefinition.objects.create(model_def=self.model_def, name='f1', max_length=10)
+            with self.assertRaises(ValueError):
+                with ModelDefinition.objects.bulk_alter():
+                    CharFieldDefinition.objects.create(model_def=self.model_def, name='f2', max_length=10)
+                    raise ValueError
+        self.assertEqual(list(self.model_def.fielddefinitions.values_list('name', flat=True)), ['f1'])
+        self.assertModelTablesColumnExists(model_class, 'f1')
+        self.assertModelTablesColumnDoesntExists(model_class, 'f2')
+
+
+class ConcurrentConstructionTest(BaseModelDefinitionTestCase):
+    manual_transaction = True
+
+    def test_single_flight(self):
+        """Concurrent threads noticing a model class is obsolete should only
+        render it once."""
+        model_class = self.model_def.model_class().model
+        # Simulate an alteration performed by another process.
+        self.model_def.bump_revision()
+        state_handler.set_checksum(self.model_def.pk, 'remote')
+        render = ModelState.render
+        renders = []
+
+        def counting_render(state, apps):
+            renders.append(state.name)
+            return render(state, apps)
+
+        start = threading.Event()
+        results = []
+
+        def construct():
+            start.wait()
+            try:
+                results.append(ModelDefinition.objects.get(pk=self.model_def.pk).model_class().model)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=construct) for _ in range(32)]
+        ModelState.render = counting_render
+        try:
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            ModelState.render = render
+        self.assertEqual(renders, ['Model'])
+        self.assertEqual(len(results), 32)
+        self.assertEqual(len(set(results)), 1)
+        self.assertIsNot(results[0], model_class)
+
+    def test_single_flight_reentrancy(self):
+        flights = SingleFlight()
+        self.assertEqual(flights.run('key', lambda: flights.run('key', lambda: 'nested')), 'nested')
+        self.assertEqual(flights.flights, {})
+
+
 class ModelDefinitionManagerTest(BaseModelDefinitionTestCase):
     def test_fields_creation(self):
         char_field = CharFieldDefinition(name='name', max_length=10)
@@ -423,6 +859,322 @@ class MutableModelProxyTest(BaseModelDefinitionTestCase):
         model._meta.local_fields.remove(fk)
 
 
+class ModelResolutionCacheTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(ModelResolutionCacheTest, self).setUp()
+        self.proxy = self.model_def.model_class()
+        checksum_lookups.reset()
+
+    def access_attributes(self):
+        for _i in range(10):
+            self.proxy._meta
+            self.proxy.objects
+            self.proxy.DoesNotExist
+
+    def test_disabled(self):
+        self.access_attributes()
+        self.assertEqual(checksum_lookups.performed, 30)
+
+    def test_enabled(self):
+        with cache_model_resolution():
+            self.access_attributes()
+        self.assertEqual(checksum_lookups.performed, 1)
+
+    def test_local_changes(self):
+        with cache_model_resolution():
+            model_class = self.proxy.model
+            CharFieldDefinition.objects.create(
+                model_def=self.model_def, name='name', max_length=10
+            )
+            self.assertIsNot(self.proxy.__get__(), model_class)
+            self.assertIn('name', [field.name for field in self.proxy._meta.fields])
+
+    def test_invalidation(self):
+        with cache_model_resolution():
+            model_class = self.proxy.model
+            self.proxy._meta
+            # Simulate an alteration performed by another process.
+            ModelDefinition.objects.filter(pk=self.model_def.pk).update(revision=models.F('revision') + 1)
+            state_handler.set_checksum(self.model_def.pk, 'remote')
+            self.assertIs(self.proxy.__get__(), model_class)
+            invalidate_model_resolution(self.model_def.pk)
+            self.assertIsNot(self.proxy.__get__(), model_class)
+
+    def test_middleware(self):
+        def view(request):
+            self.access_attributes()
+            return HttpResponse()
+        request = RequestFactory().get('/')
+        ModelResolutionCacheMiddleware(view)(request)
+        self.assertEqual(checksum_lookups.performed, 1)
+        self.assertEqual(model_resolution_cache.depth, 0)
+
+    def test_middleware_exception(self):
+        def view(request):
+            self.access_attributes()
+            raise ValueError
+        request = RequestFactory().get('/')
+        with self.assertRaises(ValueError):
+            ModelResolutionCacheMiddleware(view)(request)
+        self.assertEqual(model_resolution_cache.depth, 0)
+
+    def test_hits_touch(self):
+        with cache_model_resolution():
+            self.proxy._meta
+            access = mutable_model_registry.accesses[self.proxy.model._definition]
+            self.proxy._meta
+            self.assertGreater(mutable_model_registry.accesses[self.proxy.model._definition], access)
+
+
+class MutableModelRegistryTest(BaseModelDefinitionTestCase):
+    def test_registration(self):
+        model_class = self.model_def.model_class().model
+        definition = model_class._definition
+        self.assertIs(mutable_model_registry.get(definition), model_class)
+        version = mutable_model_registry.version
+        snapshot = mutable_model_registry.snapshot
+        remove_from_app_cache(model_class).mark_as_obsolete()
+        self.assertIsNone(mutable_model_registry.get(definition))
+        self.assertEqual(mutable_model_registry.version, version + 1)
+        # Snapshots are never mutated in place.
+        self.assertIs(snapshot[1][definition], model_class)
+        new_model_class = self.model_def.model_class().model
+        self.assertIsNot(new_model_class, model_class)
+        self.assertIs(mutable_model_registry.get(definition), new_model_class)
+        # Unregistering a class that was superseded is a noop.
+        version = mutable_model_registry.version
+        mutable_model_registry.unregister(model_class)
+        self.assertIs(mutable_model_registry.get(definition), new_model_class)
+        self.assertEqual(mutable_model_registry.version, version)
+
+    def test_lookup(self):
+        model_class = self.model_def.model_class().model
+        get_model = apps.get_model
+
+        def failing_get_model(*args, **kwargs):
+            raise AssertionError('The app registry should not be used.')
+        apps.get_model = failing_get_model
+        try:
+            self.assertIs(self.model_def.model_class().model, model_class)
+        finally:
+            apps.get_model = get_model
+
+    def test_restore(self):
+        model_class = self.model_def.model_class().model
+        with app_cache_restorer():
+            remove_from_app_cache(model_class)
+        self.assertIs(mutable_model_registry.get(model_class._definition), model_class)
+
+    def test_concurrent_registrations(self):
+        model_classes = [self.model_def.model_class().model]
+        for i in range(3):
+            model_def = ModelDefinition.objects.create(app_label='mutant', object_name="Model%d" % i)
+            model_classes.append(model_def.model_class().model)
+        version = mutable_model_registry.version
+        start = threading.Event()
+
+        def register(model_class):
+            start.wait()
+            for _i in range(100):
+                mutable_model_registry.unregister(model_class)
+                mutable_model_registry.register(model_class)
+
+        threads = [threading.Thread(target=register, args=(model_class,)) for model_class in model_classes]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mutable_model_registry.version, version + 800)
+        for model_class in model_classes:
+            self.assertIs(mutable_model_registry.get(model_class._definition), model_class)
+
+
+class ObsoleteInstanceRebindingTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(ObsoleteInstanceRebindingTest, self).setUp()
+        self.addCleanup(setattr, settings, 'REBIND_OBSOLETE_INSTANCES', settings.REBIND_OBSOLETE_INSTANCES)
+        settings.REBIND_OBSOLETE_INSTANCES = True
+        self.name_def = CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='nickname', max_length=10)
+        self.model_class = self.model_def.model_class().model
+
+    def add_field(self):
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='age', max_length=10, default='old')
+        return self.model_def.model_class().model
+
+    def test_disabled(self):
+        settings.REBIND_OBSOLETE_INSTANCES = False
+        instance = self.model_class.objects.create(name='foo')
+        self.add_field()
+        with self.assertRaisesMessage(ValidationError, 'Cannot save an obsolete model'):
+            instance.save()
+        with self.assertRaisesMessage(ValidationError, 'Cannot delete an obsolete model'):
+            instance.delete()
+
+    def test_compatible_update(self):
+        instance = self.model_class.objects.create(name='foo')
+        model_class = self.add_field()
+        model_class.objects.filter(pk=instance.pk).update(age='young')
+        instance.name = 'bar'
+        instance.save()
+        self.assertIs(instance.__class__, model_class)
+        instance = model_class.objects.get(pk=instance.pk)
+        self.assertEqual(instance.name, 'bar')
+        # Columns unknown to the obsolete model class are left untouched.
+        self.assertEqual(instance.age, 'young')
+
+    def test_compatible_insert(self):
+        instance = self.model_class(name='foo')
+        model_class = self.add_field()
+        instance.save()
+        instance = model_class.objects.get(pk=instance.pk)
+        self.assertEqual(instance.name, 'foo')
+        self.assertEqual(instance.age, 'old')
+
+    def test_incompatible_update(self):
+        instance = self.model_class.objects.create(name='foo', nickname='foo')
+        self.name_def.max_length = 20
+        self.name_def.save()
+        model_class = self.model_def.model_class().model
+        instance.nickname = 'bar'
+        with self.assertRaisesMessage(ValidationError, 'its name field changed'):
+            instance.save()
+        self.assertIs(instance.__class__, self.model_class)
+        instance.save(update_fields=['nickname'])
+        self.assertEqual(model_class.objects.get(pk=instance.pk).nickname, 'bar')
+
+    def test_update_fields_attname(self):
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def, name='ct', to=ContentType.objects.get_for_model(ContentType), null=True
+        )
+        instance = self.model_def.model_class().objects.create(name='foo')
+        model_class = self.add_field()
+        content_type = ContentType.objects.get_for_model(ModelDefinition)
+        instance.ct_id = content_type.pk
+        instance.save(update_fields=['ct_id'])
+        self.assertIs(instance.__class__, model_class)
+        self.assertEqual(model_class.objects.get(pk=instance.pk).ct, content_type)
+
+    def test_delete(self):
+        instance = self.model_class.objects.create(name='foo')
+        model_class = self.add_field()
+        instance.delete()
+        self.assertFalse(model_class.objects.exists())
+
+    def test_versions(self):
+        instance = self.model_class.objects.create(name='foo')
+        model_class = self.add_field()
+        versions = mutable_model_registry.get_versions(model_class._definition)
+        self.assertIn(self.model_class, versions)
+        self.assertIn(model_class, versions)
+        self.assertIs(instance.__class__, self.model_class)
+
+
+class ModelClassEvictionTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(ModelClassEvictionTest, self).setUp()
+        # Start from an empty registry; unregistered model classes are still
+        # resolved through the app registry.
+        mutable_model_registry.restore((0, {}))
+        self.addCleanup(setattr, settings, 'MODEL_CLASS_CACHE_SIZE', settings.MODEL_CLASS_CACHE_SIZE)
+        self.model_def.model_class(force_create=True)
+        self.model_defs = [self.model_def] + [
+            ModelDefinition.objects.create(app_label='mutant', object_name="Model%d" % i) for i in range(2)
+        ]
+
+    def test_least_recently_used(self):
+        model_classes = [model_def.model_class().model for model_def in self.model_defs]
+        self.assertEqual(mutable_model_registry.get_least_recently_used(3), [])
+        for i in (1, 0, 2):
+            model_classes[i].is_obsolete()
+        self.assertEqual(mutable_model_registry.get_least_recently_used(1), [model_classes[1], model_classes[0]])
+
+    def test_eviction(self):
+        settings.MODEL_CLASS_CACHE_SIZE = 2
+        self.model_def.model_class().objects.create()
+        model_classes = [model_def.model_class().model for model_def in self.model_defs]
+        # Constructing a model class evicts the least recently used ones.
+        ModelDefinition.objects.create(app_label='mutant', object_name='Model2')
+        self.assertEqual(len(mutable_model_registry), 2)
+        for model_class in model_classes[:2]:
+            self.assertFalse(model_class.is_obsolete())
+            self.assertIsNone(mutable_model_registry.get(model_class._definition))
+            opts = model_class._meta
+            self.assertNotIn(opts.model_name, apps.all_models[opts.app_label])
+        self.assertFalse(model_classes[2].is_obsolete())
+        # Evicted model classes are reconstructed on their next access.
+        model_class = self.model_def.model_class().model
+        self.assertIsNot(model_class, model_classes[0])
+        self.assertEqual(model_class.objects.count(), 1)
+        self.assertEqual(len(mutable_model_registry), 2)
+
+    def test_explicit_eviction(self):
+        model_class = self.model_def.model_class().model
+        for model_def in self.model_defs[1:]:
+            model_def.model_class().is_obsolete()
+        self.assertEqual(evict_model_classes(2), [model_class])
+        self.assertFalse(model_class.is_obsolete())
+
+    def test_save_evicted_instance(self):
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        instance = self.model_def.model_class().objects.create(name='foo')
+        evict_model_classes(0)
+        # Instances of evicted model classes can still be saved.
+        instance.name = 'bar'
+        instance.save()
+        model_class = self.model_def.model_class().model
+        self.assertIsNot(model_class, instance.__class__)
+        self.assertEqual(model_class.objects.get(pk=instance.pk).name, 'bar')
+
+    def test_evicted_versions_obsolete(self):
+        model_class = self.model_def.model_class().model
+        evict_model_classes(0)
+        self.model_def.model_class()
+        # Evicted versions are left alone while the state is unchanged.
+        self.assertFalse(model_class._is_obsolete)
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        self.assertTrue(model_class._is_obsolete)
+
+    def test_deleted_evicted_versions_obsolete(self):
+        model_def = self.model_defs[1]
+        model_class = model_def.model_class().model
+        evict_model_classes(0)
+        model_def.model_class()
+        model_def.delete()
+        self.assertTrue(model_class._is_obsolete)
+
+    def test_evict_related(self):
+        referencing_def = self.model_defs[1]
+        ForeignKeyDefinition.objects.create(model_def=referencing_def, name='fk', to=self.model_def)
+        model_class = self.model_def.model_class().model
+        referencing_class = referencing_def.model_class().model
+        referencing_class.objects.create(fk=model_class.objects.create())
+        for accessed in (model_class, self.model_defs[2].model_class(), referencing_class):
+            accessed.is_obsolete()
+        # Referencing model classes are evicted along with the referenced one.
+        self.assertEqual(set(evict_model_classes(2)), {model_class, referencing_class})
+        instance = self.model_def.model_class().objects.get()
+        self.assertIsNot(instance.__class__, model_class)
+        # Deletions through the rebuilt model class are cascaded.
+        instance.delete()
+        self.assertFalse(referencing_def.model_class().objects.exists())
+
+    def test_evict_related_to_static_model(self):
+        ForeignKeyDefinition.objects.create(
+            model_def=self.model_def, name='ct', to=ContentType.objects.get_for_model(ContentType), null=True
+        )
+        model_class = self.model_def.model_class().model
+        self.assertNotIn(model_class, evict_model_classes(0))
+        self.assertIs(mutable_model_registry.get(model_class._definition), model_class)
+
+    def test_model_class_size(self):
+        size = get_model_class_size(self.model_def.model_class().model)
+        self.assertGreater(size, 0)
+        CharFieldDefinition.objects.create(model_def=self.model_def, name='name', max_length=10)
+        self.assertGreater(get_model_class_size(self.model_def.model_class().model), size)
+
+
 class OrderingDefinitionTest(BaseModelDefinitionTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -1,17 +1,35 @@
 from __future__ import unicode_literals
 
 import functools
+import json
 import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
 import time
+from datetime import timedelta
 from threading import Thread
 from unittest import skipUnless
 
+import django
 from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
 from django.test import SimpleTestCase
+from django.utils import timezone
+from django.utils.encoding import force_str
 from django.utils.module_loading import import_string
 
+from mutant import settings
+from mutant.db.models import checksum_lookups
+from mutant.models import ChecksumChange
 from mutant.state import handler as state_handler
-from mutant.state.handlers.pubsub import engines as pubsub_engines
+from mutant.state.handlers.layered import LayeredStateHandler
+from mutant.state.handlers.pubsub import (
+    PubSubStateHandler, engines as pubsub_engines,
+)
 
 from .utils import BaseModelDefinitionTestCase, LoggingTestMixin
 
@@ -40,6 +58,21 @@ class StateHandlerTestMixin(object):
         state_handler.clear_checksum(0)
         self.assertIsNone(state_handler.get_checksum(0))
 
+    def test_many_interaction(self):
+        self.assertEqual(state_handler.get_many_checksums([0, 1]), {0: None, 1: None})
+        checksums = {
+            0: '397fc6229a59429ee114441b780fe7a2',
+            1: '6818bab4da85a3a138cdfa35cfc7a64f',
+        }
+        state_handler.set_many_checksums(checksums)
+        self.assertEqual(state_handler.get_many_checksums([0, 1, 2]), {
+            0: checksums[0], 1: checksums[1], 2: None,
+        })
+        self.assertEqual(state_handler.get_checksum(1), checksums[1])
+        state_handler.clear_checksum(0)
+        state_handler.clear_checksum(1)
+        self.assertEqual(state_handler.get_many_checksums([0, 1]), {0: None, 1: None})
+
 
 class ChecksumGetter(Thread):
     """Class used to fetch a checksum from a another thread since state
@@ -78,9 +111,189 @@ class CacheHandlerTest(StateHandlerTestMixin, BaseModelDefinitionTestCase):
     handler_options = {}
 
 
+class LayeredHandlerTest(StateHandlerTestMixin, BaseModelDefinitionTestCase):
+    handler_path = 'mutant.state.handlers.layered.LayeredStateHandler'
+    handler_options = {'ttl': 60}
+
+    def setUp(self):
+        super(LayeredHandlerTest, self).setUp()
+        self.handler = self.mutant_config.state_handler
+        self.addCleanup(state_handler.clear_checksum, 0)
+        self.addCleanup(state_handler.clear_checksum, 1)
+
+    def test_local_hits(self):
+        state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+        # Local writes are kept in the local map.
+        self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+        self.assertEqual(state_handler.stale, 0)
+        state_handler.reset_counters()
+        for _ in range(4):
+            self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+        self.assertIsNone(state_handler.get_checksum(1))
+        self.assertIsNone(state_handler.get_checksum(1))
+        self.assertEqual(state_handler.hits, 5)
+        self.assertEqual(state_handler.misses, 1)
+        self.assertEqual(state_handler.stale, 0)
+
+    def test_remote_changes(self):
+        remote_handler = LayeredStateHandler(ttl=60)
+        state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+        state_handler.get_checksum(0)
+        state_handler.reset_counters()
+        remote_handler.set_checksum(0, '6818bab4da85a3a138cdfa35cfc7a64f')
+        # Changes are picked up once the local map is revalidated.
+        self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+        self.mutant_config.state_handler.validated_at -= 60
+        self.assertEqual(state_handler.get_checksum(0), '6818bab4da85a3a138cdfa35cfc7a64f')
+        self.assertEqual(state_handler.hits, 1)
+        self.assertEqual(state_handler.misses, 1)
+        self.assertEqual(state_handler.stale, 1)
+        # Unchanged versions keep the local map around.
+        self.mutant_config.state_handler.validated_at -= 60
+        self.assertEqual(
+            state_handler.get_many_checksums([0]), {0: '6818bab4da85a3a138cdfa35cfc7a64f'}
+        )
+        self.assertEqual(state_handler.hits, 2)
+        self.assertEqual(state_handler.stale, 1)
+        remote_handler.clear_checksum(0)
+        self.mutant_config.state_handler.validated_at -= 60
+        self.assertIsNone(state_handler.get_checksum(0))
+
+    def test_remote_changes_per_definition(self):
+        remote_handler = LayeredStateHandler(ttl=60)
+        state_handler.set_many_checksums({
+            0: '397fc6229a59429ee114441b780fe7a2', 1: '397fc6229a59429ee114441b780fe7a2',
+        })
+        state_handler.get_many_checksums([0, 1])
+        state_handler.reset_counters()
+        remote_handler.set_checksum(1, '6818bab4da85a3a138cdfa35cfc7a64f')
+        self.handler.validated_at -= 60
+        # Only the entries of definitions changed by others are discarded.
+        self.assertEqual(state_handler.get_many_checksums([0, 1]), {
+            0: '397fc6229a59429ee114441b780fe7a2', 1: '6818bab4da85a3a138cdfa35cfc7a64f',
+        })
+        self.assertEqual(state_handler.hits, 1)
+        self.assertEqual(state_handler.misses, 1)
+        self.assertEqual(state_handler.stale, 1)
+
+    def test_concurrent_writes(self):
+        get_many_versions = self.handler.get_many_versions
+
+        def write_during_fetch(definition_pks):
+            versions = get_many_versions(definition_pks)
+            del self.handler.get_many_versions
+            state_handler.set_checksum(0, '6818bab4da85a3a138cdfa35cfc7a64f')
+            self.handler.cache.set(self.handler.get_cache_key(0), '397fc6229a59429ee114441b780fe7a2')
+            return versions
+        self.handler.get_many_versions = write_during_fetch
+        # Checksums fetched while a local write happens are not stored.
+        self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+        self.assertEqual(state_handler.get_checksum(0), '6818bab4da85a3a138cdfa35cfc7a64f')
+
+
+class DatabaseHandlerTest(StateHandlerTestMixin, BaseModelDefinitionTestCase):
+    handler_path = 'mutant.state.handlers.database.DatabaseStateHandler'
+    handler_options = {'interval': 60}
+
+    def setUp(self):
+        super(DatabaseHandlerTest, self).setUp()
+        self.handler = self.mutant_config.state_handler
+
+    def test_compaction(self):
+        for checksum in ('397fc6229a59429ee114441b780fe7a2', '6818bab4da85a3a138cdfa35cfc7a64f'):
+            state_handler.set_checksum(0, checksum)
+        state_handler.clear_checksum(0)
+        changes = ChecksumChange.objects.filter(definition_pk=0, compacted_at=None)
+        self.assertEqual(list(changes.values_list('checksum', flat=True)), [None])
+        # Tombstones are purged once pollers stopped waiting for gaps.
+        self.assertEqual(ChecksumChange.objects.filter(definition_pk=0).count(), 3)
+        ChecksumChange.objects.exclude(compacted_at=None).update(
+            compacted_at=timezone.now() - timedelta(seconds=self.handler.gap_timeout)
+        )
+        state_handler.set_checksum(1, '397fc6229a59429ee114441b780fe7a2')
+        self.assertEqual(ChecksumChange.objects.filter(definition_pk=0).count(), 1)
+
+    def test_compacted_changes(self):
+        self.handler.poll(force=True)
+        ChecksumChange.objects.create(definition_pk=0, checksum='397fc6229a59429ee114441b780fe7a2')
+        state_handler.set_checksum(0, '6818bab4da85a3a138cdfa35cfc7a64f')
+        # Compacted changes are not mistaken for uncommitted ones.
+        self.handler.poll(force=True)
+        self.assertEqual(state_handler.get_checksum(0), '6818bab4da85a3a138cdfa35cfc7a64f')
+        self.assertEqual(self.handler.gaps, {})
+
+    def test_remote_changes(self):
+        self.handler.poll(force=True)
+        ChecksumChange.objects.create(definition_pk=0, checksum='397fc6229a59429ee114441b780fe7a2')
+        # Changes are picked up on the next poll.
+        self.assertIsNone(state_handler.get_checksum(0))
+        with self.assertNumQueries(2):
+            self.handler.poll(force=True)
+        self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+        # Polling without changes only retrieves the latest revision.
+        with self.assertNumQueries(1):
+            self.handler.poll(force=True)
+
+    def test_gaps(self):
+        self.handler.poll(force=True)
+        pending = ChecksumChange.objects.create(definition_pk=0, checksum='397fc6229a59429ee114441b780fe7a2')
+        pending_pk = pending.pk
+        ChecksumChange.objects.create(definition_pk=1, checksum='6818bab4da85a3a138cdfa35cfc7a64f')
+        # Simulate a change that isn't committed yet.
+        pending.delete()
+        self.handler.poll(force=True)
+        self.assertEqual(state_handler.get_many_checksums([0, 1]), {
+            0: None, 1: '6818bab4da85a3a138cdfa35cfc7a64f',
+        })
+        self.assertEqual(list(self.handler.gaps), [pending_pk])
+        pending.pk = pending_pk
+        pending.save()
+        self.handler.poll(force=True)
+        self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+        self.assertEqual(self.handler.gaps, {})
+
+    @skipUnless(django.VERSION >= (1, 9), 'Changes are applied immediately on Django < 1.9.')
+    def test_uncommitted_changes(self):
+        self.handler.poll(force=True)
+        try:
+            with transaction.atomic():
+                state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+                # Uncommitted changes are only visible to the current thread.
+                self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+                self.handler.poll(force=True)
+                self.assertNotIn(0, self.handler.checksums)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertIsNone(state_handler.get_checksum(0))
+        self.handler.poll(force=True)
+        self.assertNotIn(0, self.handler.checksums)
+
+    @skipUnless(django.VERSION >= (1, 9), 'Changes are applied immediately on Django < 1.9.')
+    def test_committed_changes(self):
+        self.handler.poll(force=True)
+        with transaction.atomic():
+            state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+            callbacks = [func for _sids, func in connection.run_on_commit]
+        self.assertNotIn(0, self.handler.checksums)
+        # Simulate the commit of the outer transaction.
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.handler.checksums[0], '397fc6229a59429ee114441b780fe7a2')
+
+    def test_broken_transaction(self):
+        state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+        with transaction.atomic():
+            transaction.set_rollback(True)
+            with self.assertNumQueries(0):
+                self.handler.poll(force=True)
+            self.assertEqual(state_handler.get_checksum(0), '397fc6229a59429ee114441b780fe7a2')
+
+
 class MockEngine(pubsub_engines.BaseEngine):
     def __init__(self, *args, **kwargs):
         self.published = []
+        self.snapshot_checksums = None
         self._run = True
         super(MockEngine, self).__init__(*args, **kwargs)
 
@@ -92,6 +305,12 @@ class MockEngine(pubsub_engines.BaseEngine):
     def publish(self, *args):
         self.published.append(args)
 
+    def publish_many(self, messages):
+        self.published.append(list(messages))
+
+    def snapshot(self):
+        return self.snapshot_checksums
+
     def stop(self, timeout=None):
         self._run = False
         super(MockEngine, self).stop(timeout)
@@ -110,17 +329,193 @@ class PubsubHandlerTest(MemoryHandlerTest):
         self.assertEqual(state_handler.get_checksum(0), '6818bab4da85a3a138cdfa35cfc7a64f')
         state_handler.flush()
         self.assertEqual(state_handler.checksums, {})
-        self.assertNotEqual(state_handler.timestamps, {})
+        self.assertNotEqual(state_handler.revisions, {})
+
+    def test_resync(self):
+        state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+        state_handler.set_checksum(1, '6818bab4da85a3a138cdfa35cfc7a64f')
+        state_handler.set_checksum(2, '6818bab4da85a3a138cdfa35cfc7a64f')
+        revision = state_handler.clock + 10
+        state_handler.engine.snapshot_checksums = {
+            0: ('397fc6229a59429ee114441b780fe7a2', revision, 'remote'),
+            1: ('397fc6229a59429ee114441b780fe7a2', revision, 'remote'),
+            2: (None, revision, 'remote'),
+            3: ('6818bab4da85a3a138cdfa35cfc7a64f', revision, 'remote'),
+        }
+        self.assertEqual(sorted(state_handler.resync()), [1, 2, 3])
+        self.assertEqual(state_handler.checksums, {
+            0: '397fc6229a59429ee114441b780fe7a2',
+            1: '397fc6229a59429ee114441b780fe7a2',
+            3: '6818bab4da85a3a138cdfa35cfc7a64f',
+        })
+        # The clock is seeded from the snapshot revisions.
+        self.assertEqual(state_handler.revisions[2], (revision, 'remote'))
+        state_handler.set_checksum(2, '6818bab4da85a3a138cdfa35cfc7a64f')
+        self.assertEqual(state_handler.revisions[2][0], revision + 1)
+
+    def test_resync_without_snapshot(self):
+        state_handler.set_checksum(0, '397fc6229a59429ee114441b780fe7a2')
+        self.assertIsNone(state_handler.resync())
+        self.assertEqual(state_handler.checksums, {})
 
     def test_receive(self):
         state_handler.set_checksum(0, '6818bab4da85a3a138cdfa35cfc7a64f')
-        timestamp = state_handler.timestamps[0]
-        state_handler.receive(0, 'before', timestamp - 1)
+        revision, node = state_handler.revisions[0]
+        # Superseded and duplicate changes are ignored.
+        state_handler.receive(0, 'stale', revision - 1, 'remote')
+        state_handler.receive(0, 'duplicate', revision, node)
         self.assertEqual(state_handler.get_checksum(0), '6818bab4da85a3a138cdfa35cfc7a64f')
-        state_handler.receive(0, 'before', timestamp + 1)
-        self.assertEqual(state_handler.get_checksum(0), 'before')
-        state_handler.receive(0, None, timestamp + 1)
+        state_handler.receive(0, 'newer', revision + 1, 'remote')
+        self.assertEqual(state_handler.get_checksum(0), 'newer')
+        state_handler.receive(0, None, revision + 2, 'remote')
         self.assertIsNone(state_handler.get_checksum(0))
+        # Local changes supersede the ones received.
+        state_handler.set_checksum(0, '6818bab4da85a3a138cdfa35cfc7a64f')
+        self.assertEqual(state_handler.revisions[0], (revision + 3, node))
+
+    def test_bounded_revisions(self):
+        self.mutant_config.state_handler.max_revisions = 2
+        for definition_pk in range(3):
+            state_handler.receive(definition_pk, 'checksum', 1, 'remote')
+        self.assertEqual(list(state_handler.revisions), [1, 2])
+
+    def test_forgotten_revisions(self):
+        self.mutant_config.state_handler.max_revisions = 1
+        revision = state_handler.clock + 10
+        state_handler.receive(0, 'checksum', revision, 'remote')
+        state_handler.receive(1, 'checksum', 1, 'remote')
+        self.assertNotIn(0, state_handler.revisions)
+        # Revisions allocated for forgotten definitions are never lower than
+        # the ones previously received.
+        state_handler.set_checksum(0, '6818bab4da85a3a138cdfa35cfc7a64f')
+        self.assertEqual(state_handler.revisions[0][0], revision + 1)
+        # Changes of forgotten definitions are applied.
+        state_handler.receive(2, 'checksum', 1, 'remote')
+        state_handler.receive(0, 'changed', 1, 'remote')
+        self.assertEqual(state_handler.get_checksum(0), 'changed')
+
+    def test_out_of_order_deliveries(self):
+        """
+        Deliver the changes of concurrent nodes in random order with
+        duplicates and make sure every receiver converges to the same state.
+        """
+        nodes = [
+            PubSubStateHandler(engine=('tests.test_state.MockEngine', {})) for _i in range(2)
+        ]
+        receiver = PubSubStateHandler(engine=('tests.test_state.MockEngine', {}))
+        for handler in nodes + [receiver]:
+            self.addCleanup(handler.engine.stop)
+        first, second = nodes
+        first.set_checksum(0, 'first-1')
+        first.set_checksum(1, 'first-1')
+        first.set_checksum(0, 'first-2')
+        # The second node observed the first node changes before its own.
+        for message in first.engine.published:
+            second.receive(*message)
+        second.set_checksum(0, 'second-1')
+        second.clear_checksum(1)
+        # Concurrent change of the same revision.
+        first.clock = second.clock
+        first.set_checksum(2, 'first-1')
+        second.set_checksum(2, 'second-1')
+        messages = first.engine.published + second.engine.published
+        expected = None
+        rand = random.Random(42)
+        for _i in range(50):
+            deliveries = messages + rand.sample(messages, 3)
+            rand.shuffle(deliveries)
+            receiver.revisions.clear()
+            receiver.flush()
+            for message in deliveries:
+                receiver.receive(*message)
+            if expected is None:
+                expected = dict(receiver.checksums)
+            self.assertEqual(receiver.checksums, expected)
+        self.assertEqual(expected[0], 'second-1')
+        self.assertNotIn(1, expected)
+        self.assertEqual(expected[2], max([(first.node, 'first-1'), (second.node, 'second-1')])[1])
+
+
+class BatchedPubsubHandlerTest(PubsubHandlerTest):
+    handler_options = {
+        'engine': ('tests.test_state.MockEngine', {}),
+        'batch': {'interval': 60, 'size': 10},
+    }
+
+    def tearDown(self):
+        state_handler.publisher.stop()
+        super(BatchedPubsubHandlerTest, self).tearDown()
+
+    def test_batching(self):
+        for definition_pk in range(25):
+            state_handler.set_checksum(definition_pk, 'checksum')
+            self.assertEqual(state_handler.get_checksum(definition_pk), 'checksum')
+        state_handler.clear_checksum(0)
+        published = state_handler.engine.published
+        # Full batches are published without waiting for the interval.
+        while len(published) < 2:
+            time.sleep(0.01)
+        self.assertEqual([len(batch) for batch in published], [10, 10])
+        state_handler.publisher.stop()
+        self.assertEqual([len(batch) for batch in published], [10, 10, 6])
+        self.assertEqual(published[0][0][:2], (0, 'checksum'))
+        self.assertEqual(published[-1][-1][:2], (0, None))
+
+    def test_many_batching(self):
+        state_handler.set_many_checksums(dict((definition_pk, 'checksum') for definition_pk in range(15)))
+        published = state_handler.engine.published
+        while len(published) < 1:
+            time.sleep(0.01)
+        state_handler.publisher.stop()
+        self.assertEqual([len(batch) for batch in published], [10, 5])
+
+
+class StalenessWindowTest(BaseModelDefinitionTestCase):
+    def setUp(self):
+        super(StalenessWindowTest, self).setUp()
+        self._staleness_window = settings.STATE_STALENESS_WINDOW
+
+    def tearDown(self):
+        settings.STATE_STALENESS_WINDOW = self._staleness_window
+        super(StalenessWindowTest, self).tearDown()
+
+    def test_disabled(self):
+        settings.STATE_STALENESS_WINDOW = 0
+        model_class = self.model_def.model_class().model
+        checksum_lookups.reset()
+        for _ in range(5):
+            self.assertFalse(model_class.is_obsolete())
+        self.assertEqual(checksum_lookups.performed, 5)
+        self.assertEqual(checksum_lookups.avoided, 0)
+
+    def test_lookups_avoided(self):
+        settings.STATE_STALENESS_WINDOW = 60
+        model_class = self.model_def.model_class().model
+        # Retrieving the model class already checked its checksum.
+        checksum_lookups.reset()
+        for _ in range(5):
+            self.assertFalse(model_class.is_obsolete())
+        self.assertEqual(checksum_lookups.performed, 0)
+        self.assertEqual(checksum_lookups.avoided, 5)
+
+    def test_window_expiry(self):
+        settings.STATE_STALENESS_WINDOW = 60
+        model_class = self.model_def.model_class().model
+        checksum_lookups.reset()
+        self.assertFalse(model_class.is_obsolete())
+        state_handler.set_checksum(self.model_def.pk, 'remote')
+        self.assertFalse(model_class.is_obsolete())
+        model_class._checksum_checked_at -= 60
+        self.assertTrue(model_class.is_obsolete())
+        self.assertEqual(checksum_lookups.performed, 1)
+        self.assertEqual(checksum_lookups.avoided, 2)
+
+    def test_local_changes_bypass_window(self):
+        settings.STATE_STALENESS_WINDOW = 60
+        model_class = self.model_def.model_class().model
+        self.assertFalse(model_class.is_obsolete())
+        model_class.mark_as_obsolete()
+        self.assertTrue(model_class.is_obsolete())
 
 
 @skipUnless(redis, 'This state handler requires redis to be installed.')
@@ -163,6 +558,30 @@ class RedisPubSubHandlerEngineTests(LoggingTestMixin, SimpleTestCase):
         self.assertEqual(messages, [('foo', 'bar')])
         engine.stop()
 
+    def test_publish_many(self):
+        messages = []
+
+        def collect_messages(*args):
+            messages.append(args)
+
+        engine = pubsub_engines.Redis(lambda: None, collect_messages, channel=str(self))
+        engine.start()
+        while not engine.ready:
+            time.sleep(0.1)
+        engine.publish_many([('foo', 'bar'), ('baz', None)])
+        while len(messages) < 2:
+            time.sleep(0.1)
+        self.assertEqual(messages, [('foo', 'bar'), ('baz', None)])
+        engine.stop()
+
+    def test_snapshot(self):
+        engine = pubsub_engines.Redis(lambda: None, lambda *args: None, channel=str(self))
+        engine.redis.delete(engine.snapshot_key)
+        engine.publish_many([(1, 'foo', 1, 'node'), (2, 'bar', 1, 'node')])
+        engine.publish(1, None, 2, 'node')
+        self.assertEqual(engine.snapshot(), {1: (None, 2, 'node'), 2: ('bar', 1, 'node')})
+        engine.redis.delete(engine.snapshot_key)
+
     def test_disconnect_reconnects(self):
         messages = []
 
@@ -192,3 +611,151 @@ class RedisPubSubHandlerEngineTests(LoggingTestMixin, SimpleTestCase):
             time.sleep(0.1)
         self.assertEqual(messages, [('foo', 'bar')])
         engine.stop()
+
+
+class SplitPayloadsTest(SimpleTestCase):
+    def test_split(self):
+        messages = [(definition_pk, '397fc6229a59429ee114441b780fe7a2', 1, 'node') for definition_pk in range(250)]
+        payloads = list(pubsub_engines.split_payloads(messages, 7999))
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(payload) <= 7999 for payload in payloads))
+        self.assertEqual(
+            [tuple(args) for payload in payloads for args in json.loads(force_str(payload))], messages
+        )
+
+    def test_oversized_message(self):
+        messages = [(1, 'checksum', 1, 'node'), (2, 'x' * 100, 1, 'node'), (3, 'checksum', 1, 'node')]
+        payloads = [json.loads(force_str(payload)) for payload in pubsub_engines.split_payloads(messages, 50)]
+        self.assertEqual([len(payload) for payload in payloads], [1, 1, 1])
+
+
+class UnixSocketPubSubEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.messages = []
+
+    def start_engine(self):
+        engine = pubsub_engines.UnixSocket(lambda: None, self.collect_message, path=self.path)
+        engine.start()
+        while not engine.ready:
+            time.sleep(0.01)
+        self.addCleanup(engine.stop)
+        return engine
+
+    def collect_message(self, *args):
+        self.messages.append(args)
+
+    def wait_for_messages(self, count):
+        deadline = time.time() + 5
+        while len(self.messages) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_publish(self):
+        publisher = self.start_engine()
+        self.start_engine()
+        publisher.publish(1, 'checksum', 1.0)
+        self.wait_for_messages(2)
+        self.assertEqual(self.messages, [(1, 'checksum', 1.0)] * 2)
+
+    def test_publish_many(self):
+        publisher = self.start_engine()
+        messages = [(definition_pk, 'checksum', 1.0) for definition_pk in range(250)]
+        publisher.publish_many(messages)
+        self.wait_for_messages(250)
+        self.assertEqual(self.messages, messages)
+
+    def test_stale_sockets_removed(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale_address = os.path.join(self.path, 'stale.sock')
+        stale.bind(stale_address)
+        stale.close()
+        publisher = self.start_engine()
+        publisher.publish(1, None, 1.0)
+        self.wait_for_messages(1)
+        self.assertEqual(self.messages, [(1, None, 1.0)])
+        self.assertFalse(os.path.exists(stale_address))
+
+    def test_stop(self):
+        engine = self.start_engine()
+        engine.stop()
+        self.assertFalse(engine.is_alive())
+        self.assertFalse(os.path.exists(engine.address))
+
+    def test_path_permissions(self):
+        os.chmod(self.path, 0o777)
+        with self.assertRaisesMessage(ImproperlyConfigured, 'must not be accessible to other users'):
+            pubsub_engines.UnixSocket(lambda: None, self.collect_message, path=self.path)
+        path = os.path.join(self.path, 'state')
+        engine = pubsub_engines.UnixSocket(lambda: None, self.collect_message, path=path)
+        engine.socket.close()
+        engine.sender.close()
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'This engine requires PostgreSQL.')
+class PostgresPubSubEngineTests(BaseModelDefinitionTestCase):
+    manual_transaction = True
+
+    def setUp(self):
+        super(PostgresPubSubEngineTests, self).setUp()
+        self.messages = []
+        self.initializations = 0
+        self.engine = pubsub_engines.Postgres(
+            self.initialize, self.collect_message, channel='mutant_test', reconnect_delay=0.1
+        )
+        self.engine.start()
+        while not self.engine.ready:
+            time.sleep(0.1)
+        self.addCleanup(self.engine.stop)
+
+    def initialize(self):
+        self.initializations += 1
+
+    def collect_message(self, *args):
+        self.messages.append(args)
+
+    def wait_for_messages(self, count):
+        deadline = time.time() + 5
+        while len(self.messages) < count and time.time() < deadline:
+            time.sleep(0.1)
+
+    def test_publish_on_commit(self):
+        with transaction.atomic():
+            self.engine.publish(1, 'checksum', 1, 'node')
+            time.sleep(0.5)
+            self.assertEqual(self.messages, [])
+        self.wait_for_messages(1)
+        self.assertEqual(self.messages, [(1, 'checksum', 1, 'node')])
+
+    def test_publish_rollback(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.engine.publish(1, 'checksum', 1, 'node')
+                raise ValueError
+        self.engine.publish(2, None, 2, 'node')
+        self.wait_for_messages(1)
+        self.assertEqual(self.messages, [(2, None, 2, 'node')])
+
+    def test_publish_many(self):
+        messages = [(definition_pk, 'checksum', 1, 'node') for definition_pk in range(250)]
+        self.engine.publish_many(messages)
+        self.wait_for_messages(250)
+        self.assertEqual(self.messages, messages)
+
+    def test_snapshot(self):
+        self.engine.publish_many([(1, 'checksum', 1, 'node'), (2, 'checksum', 1, 'node')])
+        self.engine.publish(1, 'changed', 2, 'node')
+        self.engine.publish(2, None, 2, 'node')
+        self.assertEqual(self.engine.snapshot(), {1: ('changed', 2, 'node'), 2: (None, 2, 'node')})
+
+    def test_reconnect(self):
+        self.engine.connection.close()
+        deadline = time.time() + 5
+        while self.initializations < 2 and time.time() < deadline:
+            time.sleep(0.1)
+        # Reconnecting triggers a resynchronization.
+        self.assertEqual(self.initializations, 2)
+        self.engine.publish(1, 'checksum', 1, 'node')
+        self.wait_for_messages(1)
+        self.assertEqual(self.messages, [(1, 'checksum', 1, 'node')])